@@ -7,14 +7,13 @@ import pygame as pg
 from pygame.math import Vector2 as Vec2
 
 import settings
-from helpers import calc_dist
+from helpers import calc_dist, get_font, render_text, RotationCache
 from settings import layers, colors
+from swarm import SwarmField
 
 
 def draw_text(text, font_name, size, color):
-    font = pg.font.Font(font_name, size)
-    font.set_bold(True)
-    return font.render(text, True, color)
+    return render_text(text, get_font(font_name, size, bold=True), color)
     # text_rect = text_surface.get_rect(**{align: (x, y)})
     # screen.blit(text_surface, text_rect)
 
@@ -25,25 +24,31 @@ class Collider:
     def collide_hit_rect(one, two):
         return one.hit_rect.colliderect(two.rect)
 
+    def get_hits(self, group):
+        """ rects of the walls overlapping self.hit_rect - looked up straight from the map tiles by default """
+        if settings.tile_collisions:
+            return self.game.current_map.get_wall_rects(self.hit_rect)
+        return [sprite.rect for sprite in pg.sprite.spritecollide(self, group, False, self.collide_hit_rect)]
+
     def collide(self, group, direction):
 
         if direction == 'x':
-            hits = pg.sprite.spritecollide(self, group, False, self.collide_hit_rect)
+            hits = self.get_hits(group)
             if hits:
-                if hits[0].rect.centerx > self.hit_rect.centerx:  # sprite was moving to the right prior to collision
-                    self.pos.x = hits[0].rect.left - self.hit_rect.width / 2
-                if hits[0].rect.centerx < self.hit_rect.centerx:
-                    self.pos.x = hits[0].rect.right + self.hit_rect.width / 2
+                if hits[0].centerx > self.hit_rect.centerx:  # sprite was moving to the right prior to collision
+                    self.pos.x = hits[0].left - self.hit_rect.width / 2
+                if hits[0].centerx < self.hit_rect.centerx:
+                    self.pos.x = hits[0].right + self.hit_rect.width / 2
                 self.vel.x = 0
                 self.hit_rect.centerx = self.pos.x
 
         if direction == 'y':
-            hits = pg.sprite.spritecollide(self, group, False, self.collide_hit_rect)
+            hits = self.get_hits(group)
             if hits:
-                if hits[0].rect.centery > self.hit_rect.centery:
-                    self.pos.y = hits[0].rect.top - self.hit_rect.height / 2
-                if hits[0].rect.centery < self.hit_rect.centery:
-                    self.pos.y = hits[0].rect.bottom + self.hit_rect.height / 2
+                if hits[0].centery > self.hit_rect.centery:
+                    self.pos.y = hits[0].top - self.hit_rect.height / 2
+                if hits[0].centery < self.hit_rect.centery:
+                    self.pos.y = hits[0].bottom + self.hit_rect.height / 2
                 self.vel.y = 0
                 self.hit_rect.centery = self.pos.y
 
@@ -69,6 +74,15 @@ class FloatingMessage(pg.sprite.Sprite):
 class Mob(pg.sprite.Sprite, Collider):
 
     debugname = 'Mob (Zombie Placeholder)'
+    rotations = RotationCache(settings.rotation_step, settings.rotation_cache_size)  # shared by every mob
+
+    # simulated in game.swarm when batched_mobs is on
+    pos = SwarmField('pos')
+    vel = SwarmField('vel')
+    speed = SwarmField('speed')
+    vision_distance = SwarmField('vision_distance')
+    avoid_radius = SwarmField('avoid_radius')
+    rot = SwarmField('rot')
 
     def __init__(self, game, start_pos):
         # pygame sprite stuff
@@ -86,6 +100,7 @@ class Mob(pg.sprite.Sprite, Collider):
         # graphics
         self.image = self.standing_frames[0]
         self.orig_image = self.image
+        self.outline = None  # mouseover highlight
 
         # physics
         self.rect = self.image.get_rect(center=start_pos)
@@ -115,6 +130,11 @@ class Mob(pg.sprite.Sprite, Collider):
         self.inventory = []
         self.food = randint(5, 20)
 
+        # batched simulation
+        self.swarm = None
+        if game.swarm is not None:
+            game.swarm.add(self)
+
     def load_images(self):
         self.standing_frames = [self.game.mob_zombie_image]
 
@@ -127,11 +147,11 @@ class Mob(pg.sprite.Sprite, Collider):
         """
 
         self.rot = (target - self.hit_rect.center).angle_to(Vec2(1, 0))
-        self.image = pg.transform.rotate(self.orig_image, self.rot)
+        self.image = self.rotations.get(self.orig_image, self.rot)
 
     def avoid(self, entity_group, radius):
         """ spreads the mobs out and also effectively causes them to surround the target """
-        for entity in entity_group:
+        for entity in entity_group.query_radius(self.pos, radius):
             if entity != self:
                 dist = self.pos - entity.pos
                 if 0 < dist.length() < radius:
@@ -161,13 +181,36 @@ class Mob(pg.sprite.Sprite, Collider):
         if self.hps_regen != 0:
             self.hp_current = min(self.hp_current + (self.hps_regen * self.game.delta_time), self.hp_max)
 
-        # face the player if he's close enough to be seen
-        player_dist = calc_dist(self.pos, self.game.player.pos)
-        if player_dist <= self.vision_distance:
-            self.rotate(Vec2(self.game.player.hit_rect.center))
+        if self.swarm is not None:
+            # steering, separation, integration and wall collision already ran in self.swarm.update()
+            self.image = self.rotations.get(self.orig_image, self.rot)
+            self.rect = self.image.get_rect(center=self.pos)
+            self.hit_rect.center = self.pos
+        else:
+            self.simulate()
+
+        # keep the spatial index up to date
+        self.game.mobs.move(self)
+
+        # mouseover highlighting - drawn on top of the image, which is shared with the other mobs
+        self.outline = None
+        if self.rect.collidepoint(pg.mouse.get_pos() - self.game.camera.offset):
+            self.outline = self.get_outline()
+
+        # death conditions check
+        if self.hp_current <= 0:
+            self.die()
+
+    def simulate(self):
+        """ per-object steering and movement, for when the mobs aren't batched into a MobSwarm """
+        # face the way to the player if the player is close enough and not behind a wall
+        seen = self.game.fov.can_see(self.pos, self.vision_distance)[0]
+        if seen:
+            heading = self.game.flow_field.steer(self.hit_rect.center, self.game.player.hit_rect.center)[0]
+            self.rotate(Vec2(*heading))
         else:
             self.rot = randint(0, 360)
-            self.image = pg.transform.rotate(self.orig_image, self.rot)
+            self.image = self.rotations.get(self.orig_image, self.rot)
         self.acc = Vec2(self.speed, 0).rotate(-self.rot)
 
         # update image
@@ -179,7 +222,7 @@ class Mob(pg.sprite.Sprite, Collider):
         self.avoid(self.game.mobs, self.avoid_radius)
 
         # run forwards
-        if player_dist <= self.vision_distance:
+        if seen:
             self.acc.scale_to_length(self.speed)
             self.acc += self.vel * -1
             self.vel += self.acc * self.game.delta_time
@@ -196,14 +239,10 @@ class Mob(pg.sprite.Sprite, Collider):
         self.hit_rect.centery = self.pos.y
         self.collide(self.game.walls, 'y')
 
-        # mouseover highlighting
-        if self.rect.collidepoint(pg.mouse.get_pos() - self.game.camera.offset):
-            # self.image = self.get_outline
-            self.image.blit(self.get_outline(), self.image.get_rect())
-
-        # death conditions check
-        if self.hp_current <= 0:
-            self.die()
+    def kill(self):
+        if self.game.swarm is not None:
+            self.game.swarm.remove(self)
+        super().kill()
 
     def draw_health(self):
         hp_pct = self.hp_current / self.hp_max * 100
@@ -226,21 +265,8 @@ class Mob(pg.sprite.Sprite, Collider):
     #     draw_text(self.game.effects_screen, text, font_name, size, color, x, y, align='midbottom')
 
     def get_outline(self, color=colors.red, threshold=127):
-        """Returns an outlined image of the same size.  The image argument must
-        either be a convert surface with a set colorkey, or a convert_alpha
-        surface. The color argument is the color which the outline will be drawn.
-        In surfaces with alpha, only pixels with an alpha higher than threshold will
-        be drawn.  Colorkeyed surfaces will ignore threshold.
-        https://github.com/Mekire/pygame-image-outline/blob/master/example.py"""
-        # TODO: maybe find a better home for this? (actor superclass?)
-        mask = pg.mask.from_surface(self.image, threshold)
-        # mask = mask.scale(tuple(int(x * 1.1) for x in mask.get_size()))
-        outline_image = pg.Surface(self.image.get_size()).convert_alpha()
-        outline_image.fill((0, 0, 0, 0))
-        # outline_image.blit(self.image, outline_image.get_rect())
-        for point in mask.outline():
-            outline_image.set_at(point, color)
-        return outline_image
+        """ the outline of the current image, traced once per rotation and cached next to it """
+        return self.rotations.get_outline(self.orig_image, self.rot, color, threshold)
 
 
 class Zombie(Mob):
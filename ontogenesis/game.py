@@ -2,23 +2,29 @@
 
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 from gc import get_referrers
+from multiprocessing import freeze_support
 from os import path
 from random import choice
 
-import networkx as nx
+import numpy as np
 import pygame as pg
 from pygame.locals import FULLSCREEN
 from pygame.math import Vector2 as Vec2
 
 import settings
-from enemy import Mob, Collider
-from helpers import calc_dist
-from map import Map, WorldMap, Camera, Wall
+from helpers import PoissonDiskSampler
+from lighting import Lightmap
+from map import WorldMap, Camera, Wall, LevelCache, ChunkManager, LevelLayer
+from navigation import FlowField, Pathfinder
 from player import Player
-from settings import colors, game_configs
+from settings import colors, game_configs, layers
 from skill import LightningSkill, DashSkill, MeleeSkill, PassiveSkill
+from spatial import SpatialGroup
+from swarm import MobSwarm
 from ui import UI
+from vision import FieldOfView
 
 
 class SaveGame:
@@ -163,8 +169,6 @@ class Game:
         self.screensize = (settings.WIDTH, settings.HEIGHT)
         self.screen = self.screen_update()
         self.effects_screen = self.screen.copy().convert_alpha()
-        self.light_filter = pg.Surface(self.screen.get_size())
-        self.light_filter.fill(colors.black)
         self.current_music = None
 
         # time
@@ -175,6 +179,8 @@ class Game:
 
         # messages, debug, and logging
         self.suppressed_debug_messages = 0
+        self.sprites_drawn = 0  # last frame's sprites that got drawn, and the ones culled for being off screen
+        self.sprites_culled = 0
         self.message_flash_queue = TimeoutQueue(self.configs.flash_messages_queuesize)
         self.message_queue = MessageQueue(max_size=self.configs.messages_queuesize)
 
@@ -184,12 +190,14 @@ class Game:
         self.settings_font = None
         self.player_move_spritesheet = None
         self.load_assets()
+        self.lightmap = Lightmap(self.screen.get_size(), settings.lightmap_scale, self.light_image)
 
         # sprite groups
         self.all_sprites = pg.sprite.LayeredUpdates()
         self.hud = pg.sprite.Group()
         self.walls = pg.sprite.Group()
-        self.mobs = pg.sprite.Group()
+        self.mobs = SpatialGroup(settings.spatial_cell_size)
+        self.swarm = MobSwarm(self) if settings.batched_mobs else None
         self.projectiles = pg.sprite.Group()
         self.aoe = pg.sprite.Group()
 
@@ -205,6 +213,15 @@ class Game:
 
         # map stuff
         self.current_map = None
+        self.chunks = None
+        self.flow_field = None
+        self.pathfinder = None
+        self.fov = None
+        self.level_layer = None
+        self.level_pool = ProcessPoolExecutor(settings.mapgen_processes)
+        self.level_cache = None
+        if settings.level_cache_folder:
+            self.level_cache = LevelCache(settings.level_cache_folder, settings.level_cache_size)
         # self.player_start = self.map.player_start
 
         # state machine
@@ -345,11 +362,16 @@ class Game:
             sprite.kill()
         # self.check_player_refs()
 
+        # stop generating levels for the old world
+        if self.worldmap:
+            self.worldmap.release_all()
+
         # reset stuff
         self.all_sprites = pg.sprite.LayeredUpdates()
         self.hud = pg.sprite.Group()
         self.walls = pg.sprite.Group()
-        self.mobs = pg.sprite.Group()
+        self.mobs = SpatialGroup(settings.spatial_cell_size)
+        self.swarm = MobSwarm(self) if settings.batched_mobs else None
         self.projectiles = pg.sprite.Group()
         self.aoe = pg.sprite.Group()
         self.worldmap = None
@@ -377,21 +399,12 @@ class Game:
         # self.generate_maptiles()
 
         # get fresh game elements
-        self.worldmap = WorldMap(self)
+        self.worldmap = WorldMap(self, seed=settings.world_seed)
         # TODO: build a groups param into the WorldMap class
         self.ui.all_windows.add(self.worldmap)
         self.ui.map_menu_windows.add(self.worldmap)
-        # for node in self.worldmap.graph.nodes():
-        # atts = nx.get_node_attributes(self.worldmap.graph, 'map')
-        # print(atts)
-        atts = {node: {'map': Map(self, settings.MAP_WIDTH, settings.MAP_HEIGHT)} for node in self.worldmap.graph.nodes()}
-        # atts['map'] = Map(self, settings.MAP_WIDTH, settings.MAP_HEIGHT)
-        # print(atts)
-        nx.set_node_attributes(self.worldmap.graph, atts)
-        # print(atts)
-        # print(nx.get_node_attributes(self.worldmap.graph, 'map'))
-        # print(nx.get_node_attributes(self.worldmap.graph, 'map')[self.worldmap.current_node])
-        self.current_map = nx.get_node_attributes(self.worldmap.graph, 'map')[self.worldmap.current_node]
+        self.current_map = self.worldmap.materialize(self.worldmap.current_node)
+        self.current_map.load()
         # self.player_start = self.current_map.player_start
 
         self.generate_maptiles()
@@ -409,7 +422,10 @@ class Game:
                 return
             # generate new current map
             self.clear_map()
-            self.current_map = self.worldmap.graph.node[self.worldmap.current_node]['map']
+            self.current_map = self.worldmap.materialize(self.worldmap.destination_node)
+            if not self.current_map.ready:
+                self.ui.draw_placeholder_splash("LOADING SCREEN")
+            self.current_map.load()
             self.generate_maptiles()
             self.player.pos = self.current_map.player_start
 
@@ -426,7 +442,7 @@ class Game:
             # TODO: send the state to a 'choose destination' screen
             print('NO DESTINATION SET')
 
-    def spawn(self, entity, start_pos):
+    def spawn(self, entity, start_pos, **kwargs):
         """
         universal function to spawn a new sprite of any type
         mainly exists to provide a target for debugging hooks
@@ -437,7 +453,7 @@ class Game:
             else:
                 self.suppressed_debug_messages += 1
 
-        return entity(self, start_pos)
+        return entity(self, start_pos, **kwargs)
 
     def delay_event(self, delay, event, map_specific):
         self.delayed_events.append((pg.time.get_ticks() + delay, event, map_specific))
@@ -462,9 +478,9 @@ class Game:
     @timeit
     def generate_maptiles(self):
         """
-        loops through self.map.data and spawns walls
-        currently, this function also sets the player start position when it finds an empty tile
-            - this is kind of an efficiency hack since we're looping through the data anyways,
+        sets up the chunks that stream in the walls and mobs, then picks the mob cluster spots among the floor tiles
+        currently, this function also sets the player start position to the first empty tile
+            - this is kind of an efficiency hack since we're looking at the floor tiles anyways,
               but might need to be replaced later to separate functionality or as part of procedural gen
         """
         mob_types = [self.worldmap.graph.node[self.worldmap.current_node]['mobtype']]
@@ -472,34 +488,55 @@ class Game:
         if self.worldmap.destination_node:
             mob_types += [self.worldmap.graph.node[self.worldmap.destination_node]['mobtype']]
 
-        for x in range(self.current_map.tilewidth):
-            for y in range(self.current_map.tileheight):
-
-                if self.current_map.data[x][y] == 1:
-                    self.spawn(Wall, (x * settings.TILESIZE, y * settings.TILESIZE))
-
-                elif self.current_map.player_start is None:
-                    tile_center_x = x * settings.TILESIZE + settings.TILESIZE / 2
-                    tile_center_y = y * settings.TILESIZE + settings.TILESIZE / 2
-                    self.current_map.player_start = Vec2(int(tile_center_x), int(tile_center_y))
-
-                    if self.configs.debug:
-                        print("Player starting coordinates set to: {}".format(self.current_map.player_start))
-
-                else:
-                    # distance from player spawn
-                    player_dist = calc_dist((x * settings.TILESIZE, y * settings.TILESIZE), self.current_map.player_start)
-                    # distance from other clusters
-                    cluster_space = not any([calc_dist((x, y), cluster) < settings.cluster_dist for cluster in self.current_map.clusters])
-                    if player_dist > settings.safe_spawn_dist and cluster_space:  # random.random() > .9:
-                        # self.spawn(Mob, (x * settings.TILESIZE, y * settings.TILESIZE))
-                        self.current_map.clusters.append((x, y))
+        # walls and mobs only get spawned as their chunks go live
+        Wall.images.clear()
+        self.chunks = ChunkManager(self, self.current_map)
+        self.level_layer = LevelLayer(self.current_map)
+        self.pathfinder = None
+        if settings.path_cluster_size:
+            self.pathfinder = Pathfinder(self.current_map.data, settings.path_cluster_size)
+        self.flow_field = FlowField(self.current_map.data, settings.flow_field_radius, pathfinder=self.pathfinder)
+        self.fov = FieldOfView(self.current_map.data)
+
+        # floor tiles, in x-major order
+        floor_x, floor_y = np.nonzero(np.asarray(self.current_map.data) == 0)
+
+        if self.current_map.player_start is None and len(floor_x):
+            tile_center_x = floor_x[0] * settings.TILESIZE + settings.TILESIZE / 2
+            tile_center_y = floor_y[0] * settings.TILESIZE + settings.TILESIZE / 2
+            self.current_map.player_start = Vec2(int(tile_center_x), int(tile_center_y))
+            floor_x, floor_y = floor_x[1:], floor_y[1:]
+
+            if self.configs.debug:
+                print("Player starting coordinates set to: {}".format(self.current_map.player_start))
+
+        # clusters go on the floor tiles far enough from the player spawn, at least cluster_dist tiles from each other
+        start = self.current_map.player_start
+        player_dist = np.hypot(floor_x * settings.TILESIZE - start.x, floor_y * settings.TILESIZE - start.y)
+        far = player_dist > settings.safe_spawn_dist
+        clusters = PoissonDiskSampler(settings.cluster_dist, self.current_map.clusters)
+        clusters.sample(zip(floor_x[far].tolist(), floor_y[far].tolist()))
+        self.current_map.clusters = clusters.points
+
+        # the nests are the level's own light, which stays put - so it goes in the lightmap's static layer
+        self.lightmap.clear_static_lights()
+        if settings.nest_light_radius:
+            for x, y in self.current_map.clusters:
+                center = ((x + .5) * settings.TILESIZE, (y + .5) * settings.TILESIZE)
+                self.lightmap.add_static_light(center, settings.nest_light_radius, colors.purple)
 
         for cluster in self.current_map.clusters:
             for i in range(settings.pack_size):
                 x = (cluster[0] * settings.TILESIZE + i) + (settings.TILESIZE // 2)
                 y = (cluster[1] * settings.TILESIZE + i) + (settings.TILESIZE // 2)
-                self.spawn(choice(mob_types), (x, y))
+                self.chunks.add_mob(choice(mob_types), (x, y))
+
+        if settings.stream_chunks:
+            view = pg.Rect(0, 0, settings.WIDTH, settings.HEIGHT)
+            view.center = self.current_map.player_start
+            self.chunks.update(view)
+        else:
+            self.chunks.update()
 
     def run(self):
 
@@ -518,6 +555,7 @@ class Game:
     def quit(self):
         if settings.SYSTEM_DEBUG:
             print('Suppressed Debug Messages: {}'.format(self.suppressed_debug_messages))
+        self.level_pool.shutdown(wait=False)
         pg.quit()
         sys.exit()
 
@@ -603,27 +641,33 @@ class Game:
         """ update logic for main game loop """
         self.effects_screen.fill((0, 0, 0, 0))
 
+        self.fov.update(self.player.pos, self.player.vision_radius)
+        self.flow_field.update(self.player.pos)
+        if self.swarm is not None:
+            self.swarm.update()
         self.all_sprites.update()
         self.camera.update(target=self.player, hit_rect=True)
+        if settings.stream_chunks:
+            self.chunks.update(self.camera.viewport)
 
         self.trigger_delayed_events()
         for skill in self.active_skills:
             skill.update()
 
         # projectiles hit mobs
-        hits = pg.sprite.groupcollide(self.mobs, self.projectiles, False, True)
+        hits = self.mobs.collide_group(self.projectiles, dokill=True)
         for hit in hits:
             hit.take_damage(hits[hit][0])
             # hit.hp_current -= hits[hit][0].damage
 
         # mobs take area damage
-        hits = pg.sprite.groupcollide(self.mobs, self.aoe, False, False)
+        hits = self.mobs.collide_group(self.aoe)
         for hit in hits:
             hit.take_damage(hits[hit][0])
             # hit.hp_current -= hits[hit][0].damage
 
         # mobs hit player
-        hits = pg.sprite.spritecollide(self.player, self.mobs, False, Collider.collide_hit_rect)
+        hits = self.mobs.query_rect(self.player.hit_rect)
         for hit in hits:
             # self.player.hp_current -= hit.collision_damage
             self.player.take_damage(hits[0])
@@ -631,7 +675,7 @@ class Game:
             # if :
             self.player.pos += Vec2(hits[0].collision_knockback, 0).rotate(-hits[0].rot)
 
-        if len(self.mobs) == 0:
+        if len(self.mobs) == 0 and not self.chunks.dormant_count:
             print('All mobs defeated')
             self.flash_message('All Mobs Defeated', 3)
             if not self.worldmap.destination_node:
@@ -652,21 +696,39 @@ class Game:
             pg.draw.line(self.screen, colors.lightgrey, start_pos, end_pos, line_width)
 
     def render_light(self):
-        self.light_filter.fill(colors.black)
-        self.light_rect.center = self.camera.apply(self.player).center
-        self.light_filter.blit(self.light_image, self.light_rect)
-        self.screen.blit(self.light_filter, (0, 0), special_flags=pg.BLEND_MULT)
+        self.lightmap.add_light(self.player.rect.center, self.light_rect.width / 2)
+        for projectile in self.projectiles:
+            self.lightmap.add_light(projectile.rect.center, settings.projectile_light_radius, colors.orange)
+
+        # no light gets past the walls
+        view = self.camera.viewport
+        self.lightmap.render(self.screen, view, mask=self.fov.get_mask(view, self.lightmap.scale))
 
     def draw(self):
-        self.screen.fill(settings.BGCOLOR)
+        # floor and walls come pre-baked, the wall sprites are only there for collisions
+        self.level_layer.draw(self.screen, self.camera.viewport)
 
         if self.configs.debug:
             self.draw_grid()
 
-        for sprite in self.all_sprites:
-            if isinstance(sprite, Mob):
-                sprite.draw_health()
-            self.screen.blit(sprite.image, self.camera.apply(sprite))
+        # only what overlaps the screen gets drawn - the mobs on it come straight from their spatial index
+        view = self.camera.viewport
+        offset_x, offset_y = self.camera.camera.topleft
+        mobs_on_screen = set(self.mobs.query_rect(view))
+        self.sprites_drawn = self.sprites_culled = 0
+        for layer in self.all_sprites.layers():
+            if layer == layers.wall:
+                continue
+            for sprite in self.all_sprites.get_sprites_from_layer(layer):
+                if sprite in mobs_on_screen:
+                    sprite.draw_health()
+                elif sprite in self.mobs or not view.colliderect(sprite.rect):
+                    self.sprites_culled += 1
+                    continue
+                self.screen.blit(sprite.image, (sprite.rect.x + offset_x, sprite.rect.y + offset_y))
+                if sprite in mobs_on_screen and sprite.outline:
+                    self.screen.blit(sprite.outline, (sprite.rect.x + offset_x, sprite.rect.y + offset_y))
+                self.sprites_drawn += 1
 
         # show various object boundaries in debug mode
         if self.configs.debug:
@@ -677,7 +739,7 @@ class Game:
             pg.draw.rect(self.screen, colors.green, self.camera.apply(self.player, hit_rect=True), 2)
 
             # mob rects, hit_rects as white & green boxes
-            for mob in self.mobs:
+            for mob in mobs_on_screen:
                 pg.draw.rect(self.screen, colors.white, self.camera.apply(mob), 2)
                 pg.draw.rect(self.screen, colors.green, self.camera.apply(mob, hit_rect=True), 2)
 
@@ -693,6 +755,9 @@ class Game:
 
         if not self.configs.debug:
             self.render_light()
+        else:
+            # nothing gets lit in debug mode
+            self.lightmap.lights.clear()
 
         # TODO: merge these
         self.hud.update()
@@ -796,4 +861,5 @@ class Game:
 
 
 if __name__ == '__main__':
+    freeze_support()  # level generation workers in frozen builds
     Game(name="Dev Game").run()
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict, defaultdict
 from math import sqrt
 
+import pygame as pg
+
+import settings
+
 
 def render_outlined_text(text, font, font_color, outline_color):
     text_surface = font.render(text, True, font_color)
@@ -13,6 +18,68 @@ def render_outlined_text(text, font, font_color, outline_color):
     return final_surface
 
 
+def get_outline(image, color, threshold=127):
+    """Returns an outlined image of the same size.  The image argument must
+    either be a convert surface with a set colorkey, or a convert_alpha
+    surface. The color argument is the color which the outline will be drawn.
+    In surfaces with alpha, only pixels with an alpha higher than threshold will
+    be drawn.  Colorkeyed surfaces will ignore threshold.
+    https://github.com/Mekire/pygame-image-outline/blob/master/example.py"""
+    mask = pg.mask.from_surface(image, threshold)
+    outline_image = pg.Surface(image.get_size(), pg.SRCALPHA)
+    for point in mask.outline():
+        outline_image.set_at(point, color)
+    return outline_image
+
+
+fonts = {}  # (path, size, bold) => font, shared by everything that draws text
+
+
+def get_font(path, size, bold=False):
+    """ the shared font for path, size and boldness - loading a font parses the whole file, so it only happens once """
+    key = (path, size, bold)
+    font = fonts.get(key)
+    if font is None:
+        font = fonts[key] = pg.font.Font(path, size)
+        font.set_bold(bold)
+    return font
+
+
+class TextCache:
+    """
+    Rendered text surfaces, keyed by (text, font, color, outline color), so text that doesn't change
+    only gets rendered once - the least recently used ones get dropped past max_surfaces
+    The surfaces are shared, so they must not be drawn on
+    """
+    def __init__(self, max_surfaces=512):
+        self.max_surfaces = max_surfaces
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, text, font, color, outline=None):
+        key = (text, font, tuple(color), tuple(outline) if outline else None)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            self.misses += 1
+            surface = render_outlined_text(text, font, color, outline) if outline else font.render(text, True, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.max_surfaces:
+                self.surfaces.popitem(last=False)
+        else:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+        return surface
+
+
+text_cache = TextCache(settings.text_cache_size)
+
+
+def render_text(text, font, color, outline=None):
+    """ text rendered with font, outlined if outline is a color - cached, see TextCache """
+    return text_cache.render(text, font, color, outline)
+
+
 def get_font_height(font):
     font_object = font.render('a', False, (0, 0, 0))
     return font_object.get_rect().height
@@ -49,10 +116,72 @@ def calc_dist(point1, point2):
     return dist
 
 
+def near_pairs(points, radius):
+    """ every pair of points closer than radius, found by bucketing the points into a grid of radius-sized cells """
+    grid = defaultdict(list)
+    for point in points:
+        grid[int(point[0] // radius), int(point[1] // radius)].append(point)
+
+    pairs = []
+    for (x, y), bucket in grid.items():
+        for i, point in enumerate(bucket):
+            # the rest of this cell, and the forward half of the neighboring cells, so every pair comes up once
+            candidates = bucket[i + 1:]
+            for dx, dy in ((1, -1), (1, 0), (1, 1), (0, 1)):
+                candidates += grid.get((x + dx, y + dy), [])
+            pairs += [(point, other) for other in candidates if calc_dist(point, other) < radius]
+    return pairs
+
+
+class PoissonDiskSampler:
+    """
+    blue-noise point placement - accepts points that are at least min_dist away from every point accepted so far
+    the accepted points are bucketed into a grid of min_dist sized cells, so every check only looks at the 3x3 cells
+    around the candidate no matter how many points there are
+    """
+    def __init__(self, min_dist, points=()):
+        self.min_dist = min_dist
+        self.grid = defaultdict(list)
+        self.points = []
+        for point in points:
+            self.add(point)
+
+    def cell(self, point):
+        return int(point[0] // self.min_dist), int(point[1] // self.min_dist)
+
+    def fits(self, point):
+        x, y = self.cell(point)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for other in self.grid.get((x + dx, y + dy), ()):
+                    if calc_dist(point, other) < self.min_dist:
+                        return False
+        return True
+
+    def add(self, point):
+        self.grid[self.cell(point)].append(point)
+        self.points.append(point)
+
+    def sample(self, candidates):
+        """ tries the candidates in order, returns the ones that got accepted """
+        accepted = []
+        for point in candidates:
+            if self.fits(point):
+                self.add(point)
+                accepted.append(point)
+        return accepted
+
+
 def get_closest_sprite(group, pos, radius=None, get_range=False, get_all=False):
+    # spatially indexed groups (see spatial.SpatialGroup) only need to look at the nearby sprites
+    if hasattr(group, 'nearest') and not get_all:
+        closest = group.nearest(pos, radius=radius)
+        closest_sprite, distance = closest[0] if closest else (None, None)
+        return (closest_sprite, distance) if get_range else closest_sprite
     if radius:
         distances = {}
-        for sprite in group:
+        candidates = group.query_radius(pos, radius) if hasattr(group, 'query_radius') else group
+        for sprite in candidates:
             distance = calc_dist(sprite.pos, pos)
             if distance < radius:
                 distances[sprite] = distance
@@ -65,3 +194,66 @@ def get_closest_sprite(group, pos, radius=None, get_range=False, get_all=False):
         return closest_sprite, distances[closest_sprite]
     return closest_sprite
 
+
+class DisjointSet:
+    """ union-find over the integers 0..size-1, with path halving and union by size """
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, item1, item2):
+        """ merges the sets containing item1 and item2, returns False if they were already merged """
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return False
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+        return True
+
+    def connected(self, item1, item2):
+        return self.find(item1) == self.find(item2)
+
+
+class RotationCache:
+    """
+    Rotated copies of images, one per angle bucket of step degrees, shared by everything that rotates the same image
+    The outlines of the rotated images are kept alongside them, for highlighting
+    Filled as the angles come up, and holds at most max_images surfaces - the least recently used get dropped
+    """
+    def __init__(self, step=5, max_images=1024):
+        self.step = step
+        self.buckets = int(round(360 / step))
+        self.max_images = max_images
+        self.images = OrderedDict()  # (image, bucket) => rotated image, (image, bucket, color, threshold) => outline
+
+    def bucket(self, angle):
+        return int(round(angle / self.step)) % self.buckets
+
+    def lookup(self, key, build):
+        surface = self.images.get(key)
+        if surface is None:
+            surface = self.images[key] = build()
+            if len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        else:
+            self.images.move_to_end(key)
+        return surface
+
+    def get(self, image, angle):
+        bucket = self.bucket(angle)
+        return self.lookup((image, bucket), lambda: pg.transform.rotate(image, bucket * self.step))
+
+    def get_outline(self, image, angle, color, threshold=127):
+        """ the outline of the rotated image, to blit on top of it """
+        key = (image, self.bucket(angle), color, threshold)
+        return self.lookup(key, lambda: get_outline(self.get(image, angle), color, threshold))
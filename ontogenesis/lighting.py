@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import pygame as pg
+
+from settings import colors
+
+
+class Lightmap:
+    """
+    The lights on screen, added up in a buffer at 1/scale of the screen resolution and scaled up once per frame -
+    every light is a blit into the small buffer, and the screen still only gets one full-size multiply
+
+    Dynamic lights are added every frame with add_light, and are used up by the next render. Static lights (the
+    ones placed on the level) stay put in map coordinates and get added up into a layer of their own, which is only
+    rebuilt once the view moves past its margin or the static lights change
+    """
+    def __init__(self, screen_size, scale, light_image, ambient=colors.black, margin=256):
+        self.scale = scale
+        self.light_image = light_image  # the shape of every light, white where it's brightest
+        self.ambient = ambient
+        self.margin = margin  # pixels of static lights kept around the view
+        self.buffer = pg.Surface((-(-screen_size[0] // scale), -(-screen_size[1] // scale)))
+        self.scaled = pg.Surface((self.buffer.get_width() * scale, self.buffer.get_height() * scale))
+        # smoothscale costs by the size it writes, so past 2x it only goes half way and a plain 2x scale does the rest
+        self.half = pg.Surface((self.scaled.get_width() // 2, self.scaled.get_height() // 2)) if scale > 2 else None
+        self.images = {}  # (diameter, color) => light image at buffer resolution
+        self.lights = []  # (map position, image) for this frame
+        self.static_lights = []
+        self.static_view = None  # map rect the static layer covers, None when it needs rebuilding
+        self.static_layer = None
+
+    def get_image(self, radius, color):
+        size = max(int(2 * radius / self.scale), 1)
+        key = (size, tuple(color))
+        if key not in self.images:
+            # flatten the light onto black, so adding it up only goes by brightness
+            image = pg.Surface((size, size))
+            image.fill(colors.black)
+            image.blit(pg.transform.smoothscale(self.light_image, (size, size)), (0, 0))
+            if key[1] != colors.white:
+                image.fill(color, special_flags=pg.BLEND_MULT)
+            self.images[key] = image
+        return self.images[key]
+
+    def add_light(self, pos, radius, color=colors.white):
+        """ lights up radius pixels around pos (in map coordinates) for the next frame """
+        self.lights.append((pos, self.get_image(radius, color)))
+
+    def add_static_light(self, pos, radius, color=colors.white):
+        """ a light that stays at pos until clear_static_lights """
+        self.static_lights.append((pos, self.get_image(radius, color)))
+        self.static_view = None
+
+    def clear_static_lights(self):
+        self.static_lights.clear()
+        self.static_view = None
+
+    def add_up(self, surface, origin, lights):
+        """ adds lights onto surface, whose top left is at origin in map coordinates """
+        for (x, y), image in lights:
+            rect = image.get_rect(center=((x - origin[0]) / self.scale, (y - origin[1]) / self.scale))
+            surface.blit(image, rect, special_flags=pg.BLEND_ADD)
+
+    def render(self, screen, view, mask=None):
+        """
+        multiplies the lights inside view (the map rect on screen) onto screen
+        mask is an optional (surface, map position) pair at buffer resolution, multiplied in before scaling up
+        """
+        self.buffer.fill(self.ambient)
+
+        if self.static_lights:
+            if self.static_view is None or not self.static_view.contains(view):
+                self.static_view = view.inflate(self.margin * 2, self.margin * 2)
+                self.static_layer = pg.Surface((self.static_view.width // self.scale, self.static_view.height // self.scale))
+                self.static_layer.fill(colors.black)
+                self.add_up(self.static_layer, self.static_view.topleft, self.static_lights)
+            offset = ((self.static_view.x - view.x) // self.scale, (self.static_view.y - view.y) // self.scale)
+            self.buffer.blit(self.static_layer, offset, special_flags=pg.BLEND_ADD)
+
+        self.add_up(self.buffer, view.topleft, self.lights)
+        self.lights.clear()
+
+        if mask is not None:
+            surface, (x, y) = mask
+            self.buffer.blit(surface, ((x - view.x) // self.scale, (y - view.y) // self.scale), special_flags=pg.BLEND_MULT)
+
+        if self.half is None:
+            pg.transform.smoothscale(self.buffer, self.scaled.get_size(), self.scaled)
+        else:
+            pg.transform.smoothscale(self.buffer, self.half.get_size(), self.half)
+            pg.transform.scale(self.half, self.scaled.get_size(), self.scaled)
+        screen.blit(self.scaled, (0, 0), special_flags=pg.BLEND_MULT)
@@ -1,17 +1,148 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import heapq
+import json
+import os
 import random
-from itertools import product, combinations, cycle
-from math import sqrt
+import time
+from collections import OrderedDict, defaultdict
+from itertools import product, cycle
+from os import path
 
 import networkx as nx
+import numpy as np
 import pygame as pg
 from pygame.math import Vector2 as Vec2
 
 import settings
 from enemy import Zombie, GiantLizard
-from helpers import calc_dist
-from settings import colors
+from helpers import calc_dist, near_pairs, DisjointSet, PoissonDiskSampler
+from settings import colors, layers
+
+
+def count_adjacent_walls(level, diagonals=True):
+    """ counts the walls around every cell of an ndarray level at once, by summing shifted views of the padded grid """
+    width, height = level.shape
+    padded = np.pad(level, 1, mode='constant')
+    offsets = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+    if diagonals:
+        offsets += [(-1, -1), (1, -1), (-1, 1), (1, 1)]
+
+    counts = np.zeros((width, height), dtype=np.int8)
+    for dx, dy in offsets:
+        counts += padded[1 + dx:1 + dx + width, 1 + dy:1 + dy + height]
+    return counts
+
+
+def label_caves(level):
+    """
+    two-pass connected component labeling of the floor tiles (4-connected)
+    works on vertical runs of floor rather than single tiles, so the python-level work scales with the number of runs
+
+    returns the label grid (0 for walls), the size of each label, its bounding box as (min_x, min_y, max_x, max_y)
+    and a representative tile for each label
+    """
+    floor = np.asarray(level) == 0
+    width, height = floor.shape
+
+    # runs of floor down each column, in (x, y) order
+    edges = np.diff(np.pad(floor, ((0, 0), (1, 1)), mode='constant').astype(np.int8), axis=1)
+    run_x, run_start = np.nonzero(edges == 1)
+    run_end = np.nonzero(edges == -1)[1]
+    num_runs = len(run_x)
+
+    # first pass - union every pair of runs in neighboring columns that overlap
+    # with a column stride bigger than the height, the runs of column x + 1 that overlap a run of column x are a
+    # contiguous slice of the sorted run keys, found by two binary searches
+    stride = height + 1
+    start_keys = run_x * stride + run_start
+    end_keys = run_x * stride + run_end
+    first = np.searchsorted(end_keys, start_keys + stride, side='right')
+    last = np.searchsorted(start_keys, end_keys + stride, side='left')
+    overlaps = np.maximum(last - first, 0)
+    runs = np.repeat(np.arange(num_runs), overlaps)
+    overlapping = np.repeat(first - np.cumsum(overlaps) + overlaps, overlaps) + np.arange(overlaps.sum())
+
+    regions = DisjointSet(num_runs)
+    for run, other in zip(runs.tolist(), overlapping.tolist()):
+        regions.union(run, other)
+
+    # second pass - number the regions and paint them back onto the grid
+    roots = np.array([regions.find(run) for run in range(num_runs)], dtype=np.int64)
+    unique_roots, first_runs, run_labels = np.unique(roots, return_index=True, return_inverse=True)
+    run_labels = run_labels.reshape(-1) + 1
+    num_labels = len(unique_roots) + 1
+
+    lengths = run_end - run_start
+    tiles = np.repeat(run_x * height + run_start - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    labels = np.zeros((width, height), dtype=np.int32)
+    labels.reshape(-1)[tiles] = np.repeat(run_labels, lengths)
+
+    sizes = np.bincount(run_labels, weights=lengths, minlength=num_labels).astype(np.int64)
+    bounds = np.zeros((num_labels, 4), dtype=np.int64)
+    bounds[:, 0:2] = (width, height)
+    np.minimum.at(bounds[:, 0], run_labels, run_x)
+    np.minimum.at(bounds[:, 1], run_labels, run_start)
+    np.maximum.at(bounds[:, 2], run_labels, run_x)
+    np.maximum.at(bounds[:, 3], run_labels, run_end - 1)
+
+    points = [None] + [(int(run_x[run]), int(run_start[run])) for run in first_runs]
+
+    return labels, sizes, bounds, points
+
+
+def link_caves(labels):
+    """
+    candidate tunnels between neighboring caves, as (distance, cave1, cave2, point1, point2) sorted by distance
+    where point1 and point2 are the closest floor tiles of the two caves
+
+    every cave grows into the walls around it one tile per pass (a multi-source BFS done with shifted views),
+    so each wall tile ends up owned by its closest cave and remembers the floor tile it was reached from.
+    caves whose grown regions touch are neighbors - the regions cover the whole map, so those links always connect
+    every cave - and the link between two caves is the shortest one over all the places their regions touch
+    """
+    labels = np.asarray(labels)
+    width, height = labels.shape
+    owner = labels.astype(np.int32)
+    source = np.where(owner > 0, np.arange(owner.size).reshape(owner.shape), -1)
+    if not owner.any():
+        return []
+
+    directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+    while not owner.all():
+        padded_owner = np.pad(owner, 1, mode='constant')
+        padded_source = np.pad(source, 1, mode='constant')
+        for dx, dy in directions:
+            neighbor = padded_owner[1 + dx:1 + dx + width, 1 + dy:1 + dy + height]
+            take = (owner == 0) & (neighbor > 0)
+            owner[take] = neighbor[take]
+            source[take] = padded_source[1 + dx:1 + dx + width, 1 + dy:1 + dy + height][take]
+
+    # every pair of touching tiles owned by different caves is a candidate link
+    pairs = [(owner[:-1, :], owner[1:, :], source[:-1, :], source[1:, :]),
+             (owner[:, :-1], owner[:, 1:], source[:, :-1], source[:, 1:])]
+    cave1 = np.concatenate([first[first != second] for first, second, _, _ in pairs])
+    cave2 = np.concatenate([second[first != second] for first, second, _, _ in pairs])
+    point1 = np.concatenate([source1[first != second] for first, second, source1, _ in pairs])
+    point2 = np.concatenate([source2[first != second] for first, second, _, source2 in pairs])
+    if not len(cave1):
+        return []
+
+    x1, y1 = np.divmod(point1, height)
+    x2, y2 = np.divmod(point2, height)
+    distance = np.hypot(x1 - x2, y1 - y2)
+
+    # keep the shortest link for each pair of caves
+    low, high = np.minimum(cave1, cave2), np.maximum(cave1, cave2)
+    order = np.lexsort((distance, high, low))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (low[order][1:] != low[order][:-1]) | (high[order][1:] != high[order][:-1])
+    shortest = order[first]
+    shortest = shortest[np.argsort(distance[shortest], kind='mergesort')]
+
+    return [(distance[i], int(cave1[i]), int(cave2[i]), (int(x1[i]), int(y1[i])), (int(x2[i]), int(y2[i])))
+            for i in shortest.tolist()]
 
 
 class Camera:
@@ -44,10 +175,165 @@ class Camera:
 
         self.camera = pg.Rect(x, y, self.width, self.height)
 
+    @property
+    def viewport(self):
+        """ the part of the map that is on screen, in map coordinates """
+        return pg.Rect(-self.offset.x, -self.offset.y, settings.WIDTH, settings.HEIGHT)
+
+
+class ChunkManager:
+    """
+    Streams the sprites of a Map in square chunks of tiles, so only the chunks around the viewport
+    and around the mobs that are chasing the player have live walls and mobs
+
+    Mobs outside the live chunks are parked in their chunk - as (mob type, position) before they ever spawned,
+    and as the sprite itself after that - and come back once their chunk loads again.
+    Collisions against the map itself don't need any of this, they go straight to the tiles (see tile_collisions)
+    """
+    def __init__(self, game, level_map, chunk_size=None, margin=None):
+        self.game = game
+        self.map = level_map
+        self.chunk_size = chunk_size or settings.chunk_size  # tiles
+        self.margin = settings.chunk_margin if margin is None else margin  # chunks kept live around the viewport
+        self.chunk_pixels = self.chunk_size * settings.TILESIZE
+        self.width = -(-level_map.tilewidth // self.chunk_size)  # chunks
+        self.height = -(-level_map.tileheight // self.chunk_size)
+        self.loaded = {}  # chunk => its wall sprites
+        self.dormant = defaultdict(list)  # chunk => parked mobs
+
+    @property
+    def dormant_count(self):
+        return sum(len(mobs) for mobs in self.dormant.values())
+
+    def chunk_at(self, pos):
+        x = min(max(int(pos[0] // self.chunk_pixels), 0), self.width - 1)
+        y = min(max(int(pos[1] // self.chunk_pixels), 0), self.height - 1)
+        return x, y
+
+    def chunks_in(self, rect):
+        """ the chunks overlapping rect, plus the margin around them """
+        left, top = self.chunk_at(rect.topleft)
+        right, bottom = self.chunk_at((rect.right - 1, rect.bottom - 1))
+        return {(x, y)
+                for x in range(max(left - self.margin, 0), min(right + self.margin, self.width - 1) + 1)
+                for y in range(max(top - self.margin, 0), min(bottom + self.margin, self.height - 1) + 1)}
+
+    def add_mob(self, mob_type, pos):
+        """ queues up a mob to spawn whenever its chunk goes live """
+        self.dormant[self.chunk_at(pos)].append((mob_type, pos))
+
+    def update(self, view=None):
+        """ loads the chunks around view (the whole map if there is no view) and unloads the rest """
+        if view is None:
+            needed = set(product(range(self.width), range(self.height)))
+        else:
+            needed = self.chunks_in(view)
+
+        # mobs that are chasing the player keep the chunks they are in live
+        player = self.game.player
+        stray = []
+        for mob in self.game.mobs:
+            chunk = self.chunk_at(mob.pos)
+            if player and self.game.fov.can_see(mob.pos, mob.vision_distance)[0]:
+                needed.add(chunk)
+            elif chunk not in needed:
+                stray.append((chunk, mob))
+
+        # park the mobs that wandered out of the live chunks, or got left behind
+        for chunk, mob in stray:
+            if chunk not in needed:
+                mob.kill()
+                self.dormant[chunk].append(mob)
+
+        for chunk in set(self.loaded) - needed:
+            self.unload(chunk)
+        for chunk in needed - set(self.loaded):
+            self.load(chunk)
+
+    def load(self, chunk):
+        size = self.chunk_size
+        left, top = chunk[0] * size, chunk[1] * size
+        tiles = self.map.data[left:left + size, top:top + size]
+        self.loaded[chunk] = [self.game.spawn(Wall, ((left + x) * settings.TILESIZE, (top + y) * settings.TILESIZE),
+                                              size=(width * settings.TILESIZE, height * settings.TILESIZE))
+                              for x, y, width, height in mesh_walls(tiles)]
+
+        for mob in self.dormant.pop(chunk, []):
+            if isinstance(mob, tuple):
+                self.game.spawn(*mob)
+            else:
+                mob.add(self.game.all_sprites, self.game.mobs)
+                if self.game.swarm is not None:
+                    self.game.swarm.add(mob)
+
+    def unload(self, chunk):
+        for wall in self.loaded.pop(chunk):
+            wall.kill()
+
+
+class LevelLayer:
+    """
+    The floor and walls of a Map baked into surfaces, so drawing the static part of a level is a blit of
+    whatever is on screen instead of one per wall sprite
+
+    Big maps are baked in square pages of page_size tiles as they come into view - enough of them are kept
+    to cover the screen, the least recently drawn ones get dropped past that
+    """
+    def __init__(self, level_map, page_size=None):
+        self.map = level_map
+        self.page_size = page_size or settings.level_page_size  # tiles
+        self.page_pixels = self.page_size * settings.TILESIZE
+        # the most pages the screen can overlap at once
+        self.max_pages = ((settings.WIDTH - 2) // self.page_pixels + 2) * ((settings.HEIGHT - 2) // self.page_pixels + 2)
+        self.pages = OrderedDict()  # page => surface, least recently drawn first
+        self.data = level_map.data  # the level the pages were baked from
+
+    def invalidate(self):
+        """ drops the baked pages, for when the level data changes """
+        self.pages.clear()
+        self.data = self.map.data
+
+    def bake(self, page):
+        """ one pixel per tile, scaled up to the tile size """
+        size = self.page_size
+        left, top = page[0] * size, page[1] * size
+        walls = np.asarray(self.map.data)[left:left + size, top:top + size] == 1
+        pixels = np.empty(walls.shape + (3,), dtype=np.uint8)
+        pixels[:] = settings.BGCOLOR
+        pixels[walls] = colors.brown
+        size = (walls.shape[0] * settings.TILESIZE, walls.shape[1] * settings.TILESIZE)
+        image = pg.transform.scale(pg.surfarray.make_surface(pixels), size)
+        return image.convert() if pg.display.get_surface() else image
+
+    def get_page(self, page):
+        if page in self.pages:
+            self.pages.move_to_end(page)
+        else:
+            self.pages[page] = self.bake(page)
+            if len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return self.pages[page]
+
+    def draw(self, surface, view):
+        """ blits the part of the level inside view (a rect in map coordinates) onto surface """
+        if self.map.data is not self.data:
+            # Map.set_level swapped the level out from under the baked pages
+            self.invalidate()
+        if not pg.Rect(0, 0, self.map.width, self.map.height).contains(view):
+            surface.fill(settings.BGCOLOR)
+        left, top = max(view.left // self.page_pixels, 0), max(view.top // self.page_pixels, 0)
+        right = min((view.right - 1) // self.page_pixels, (self.map.tilewidth - 1) // self.page_size)
+        bottom = min((view.bottom - 1) // self.page_pixels, (self.map.tileheight - 1) // self.page_size)
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                surface.blit(self.get_page((x, y)), (x * self.page_pixels - view.x, y * self.page_pixels - view.y))
+
 
 class WorldMap:
-    def __init__(self, game, width=12, height=10, min_dist=3, path_base_chance=.07, path_length_bonus=.23):
+    def __init__(self, game, width=12, height=10, min_dist=3, path_base_chance=.07, path_length_bonus=.23, seed=None):
         self.game = game
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.random = random.Random(self.seed)
         self.mob_types = cycle([Zombie, GiantLizard])
         self.image = None
         self.visible = False
@@ -59,6 +345,11 @@ class WorldMap:
         self.path_base_chance = path_base_chance
         self.path_length_bonus = path_length_bonus
 
+        # node maps are only built once a node is discovered or picked as a destination, and the least recently used
+        # ones that aren't next to the current node get dropped again once they take up more than the memory budget
+        self.resident = OrderedDict()  # node => Map, least recently used first
+        self.memory_budget = settings.map_memory_budget
+
         self.graph = None
         # print('graph before gen: {}'.format(self.graph))
         self.generate_graph()
@@ -78,10 +369,10 @@ class WorldMap:
         #     # print((x, 0), (x, self.image.get_height()))
         #     pg.draw.line(self.image, colors.red, (0, y), (self.image.get_width(), y), line_width)
 
-        self.current_node = random.choice([*self.graph.nodes()])  # random starting location for now
+        self.current_node = self.random.choice([*self.graph.nodes()])  # random starting location for now
+        self.destination_node = None
         self.discover_node(self.current_node, neighbors=True)
         self.visit_node(self.current_node)
-        self.destination_node = None
         # print(self.current_node)
         # nodesAt5 = filter(lambda (n, d): d['at'] == 5, P.nodes(data=True))
         all_shortest_paths = nx.single_source_shortest_path_length(self.graph, self.current_node)
@@ -101,25 +392,76 @@ class WorldMap:
 
     def discover_node(self, node, neighbors=False):
         self.graph.node[node]['discovered'] = True
+        self.materialize(node)
         if neighbors:
             for neighbor in self.graph.neighbors(node):
                 self.graph.node[neighbor]['discovered'] = True
+                self.materialize(neighbor)
+
+    def materialize(self, node):
+        """
+        returns the Map for node, starting its generation on the game's level pool if it isn't resident
+        the map is rebuilt from the node seed (or the level cache) every time, so evicted maps come back the same
+        """
+        if node in self.resident:
+            self.resident.move_to_end(node)
+            return self.resident[node]
+
+        width, height = settings.MAP_WIDTH, settings.MAP_HEIGHT
+        seed = self.node_seed(node)
+        cache = self.game.level_cache
+        pending = None
+        if not (cache and cache.contains(cache.key(width, height, seed))):
+            pending = self.game.level_pool.submit(generate_level, width, height, seed, cache)
+        level_map = Map(self.game, width, height, seed=seed, cache=cache, pending=pending)
+
+        self.graph.node[node]['map'] = level_map
+        self.resident[node] = level_map
+        self.evict()
+        return level_map
+
+    @property
+    def resident_bytes(self):
+        return sum(level_map.nbytes for level_map in self.resident.values())
+
+    def evict(self):
+        """ drops least recently used maps until we're under the memory budget, keeping the ones next to us """
+        keep = {self.current_node, self.destination_node, *self.graph.neighbors(self.current_node)}
+        for node in list(self.resident)[:-1]:  # never the map that was just asked for
+            if self.resident_bytes <= self.memory_budget:
+                break
+            if node not in keep:
+                self.release(node)
+
+    def release(self, node):
+        level_map = self.resident.pop(node)
+        if level_map.pending:
+            level_map.pending.cancel()
+        del self.graph.node[node]['map']
+
+    def release_all(self):
+        for node in list(self.resident):
+            self.release(node)
+
+    def node_seed(self, node):
+        """ derives a stable level seed for a node from the world seed """
+        digest = hashlib.sha1('{}:{}:{}'.format(self.seed, *node).encode()).digest()
+        return int.from_bytes(digest[:4], 'little')
 
     def visit_node(self, node):
         self.graph.node[node]['visited'] = True
 
     def generate_graph(self):
-        print('Generating new WorldMap')
+        """
+        places the nodes at least min_dist apart, joins them with a random spanning tree over the nearby pairs,
+        then adds some of the other nearby pairs back as extra paths
+        connected by construction, and close to linear in the number of nodes
+        """
+        print('Generating new WorldMap (seed {})'.format(self.seed))
         graph = nx.Graph()
-        node_coords = []
         tile_coords = [tile for tile in product(range(1, self.width - 1), range(1, self.height - 1))]
-        random.shuffle(tile_coords)
-        for location in tile_coords:
-            for node in node_coords:
-                if calc_dist(location, node) < self.min_dist:
-                    break
-            else:
-                node_coords.append(location)
+        self.random.shuffle(tile_coords)
+        node_coords = PoissonDiskSampler(self.min_dist).sample(tile_coords)
         # scale node coordinates to map image locations
         # node_coords = [(int(node[0] * self.scalex), int(node[1] * self.scaley)) for node in node_coords]
         nodes = {pos: {'name': pos, 'position': pos, 'discovered': False, 'visited': False, 'mobtype': next(self.mob_types), 'goal': False} for node_name, pos in enumerate(node_coords)}
@@ -127,28 +469,31 @@ class WorldMap:
         #
         # node_positions = {k: k for k, v in nodes.items()}
 
-        edges = [(edge[0], edge[1], {'weight': calc_dist(edge[0], edge[1])}) for edge in combinations(node_coords, 2)]
+        # every tile is closer than min_dist to some node, and neighboring tiles are 1 apart, so the pairs of nodes
+        # closer than 2 * min_dist + 1 are enough to connect all of them
+        link_dist = 2 * self.min_dist + 1
+        edges = [(node1, node2, {'weight': calc_dist(node1, node2)}) for node1, node2 in near_pairs(node_coords, link_dist)]
+
+        # kruskal over randomly stretched lengths gives a random spanning tree that still favors short paths
+        index = {node: i for i, node in enumerate(node_coords)}
+        components = DisjointSet(len(node_coords))
+        self.random.shuffle(edges)
+        edges.sort(key=lambda edge: edge[2]['weight'] * self.random.uniform(.5, 1.5))
+        tree = []
+        extras = []
+        for edge in edges:
+            if components.union(index[edge[0]], index[edge[1]]):
+                tree.append(edge)
+            else:
+                extras.append(edge)
 
-        prune_targets = [edge for edge in edges if self.calc_prune_chance(edge) < random.random()]
+        # the rest of the nearby pairs survive with the old pruning odds, short ones more often
+        extras = [edge for edge in extras if self.random.random() < self.calc_prune_chance(edge)]
 
         graph.add_nodes_from(nodes.items())
-        graph.add_edges_from(edges)
-
-        # prune the prune targets in random order *unless they are the only remaining path to the node*
-        random.shuffle(prune_targets)
-        for target in prune_targets:
-            if len(graph[target[0]]) > 1 and len(graph[target[1]]) > 1:
-                graph.remove_edge(*target[:2])
-
-        # recurse if we end up with a unconnected graph
-        # TODO: check if the largest subgraph is "large enough" and maybe use it
-        if not nx.is_connected(graph):
-            print("NOT CONNECTED - generating new worldmap graph")
-            self.generate_graph()
-        else:
-            print("CONNECTED - setting worldmap graph")
-            self.graph = graph
-            # print(graph)
+        graph.add_edges_from(tree + extras)
+        self.graph = graph
+
         # return graph
         # print('TEST')
         # print(graph.nodes())
@@ -221,43 +566,220 @@ class WorldMap:
             relative_pos = Vec2(event.pos)  # - Vec2(self.button_up.get_abs_offset()) - Vec2(self.rect.topleft)
             closest_node = self.get_closest_node(relative_pos)
             self.destination_node = closest_node
+            self.materialize(closest_node)
 
 
 class Map:
     """ who needs a map? """
     # TODO: this should probably be refactored, currently it's just a container with no methods
-    # TODO: get_cave method, which returns the cave that a given (x, y) position is in
-    def __init__(self, game, tilewidth, tileheight):
+    def __init__(self, game, tilewidth, tileheight, seed=None, cache=None, pending=None):
         self.game = game
         self.tilewidth = tilewidth
         self.tileheight = tileheight
         self.width = self.tilewidth * settings.TILESIZE
         self.height = self.tileheight * settings.TILESIZE
-        self.generator = CellularAutomata()
-        self.data = self.generator.generate_level(self.tilewidth, self.tileheight)
-        # self.caves = self.generator.caves
+        self.seed = seed
+
+        # level generation can happen elsewhere (see WorldMap.materialize), in which case pending is the Future
+        # that will hand back the finished level - load() collects it
+        self.pending = pending
+        self.data = None
+        self.cave_labels = None
+        if self.pending is None:
+            self.set_level(*generate_level(self.tilewidth, self.tileheight, seed, cache))
 
         self.clusters = []
 
         self.player_start = None
 
+    @property
+    def ready(self):
+        return self.pending is None or self.pending.done()
+
+    def set_level(self, data, cave_labels):
+        # the pure-Python generator hands back nested lists, everything past here indexes the level as an array
+        self.data = np.asarray(data, dtype=np.int8)
+        self.cave_labels = cave_labels
+
+    @property
+    def nbytes(self):
+        """ memory taken by the level data, estimated from the size until it's loaded """
+        if isinstance(self.data, np.ndarray) and isinstance(self.cave_labels, np.ndarray):
+            return self.data.nbytes + self.cave_labels.nbytes
+        return self.tilewidth * self.tileheight * 5  # int8 level + int32 labels
+
+    def load(self):
+        """ makes sure the level data is here, blocking until a pending generation finishes """
+        if self.pending is not None:
+            self.set_level(*self.pending.result())
+            self.pending = None
+
+    def get_wall_rects(self, rect):
+        """ rects of the wall tiles under rect, read straight from self.data - the cost depends on rect, not the map """
+        tilesize = settings.TILESIZE
+        left = max(rect.left // tilesize, 0)
+        right = min((rect.right - 1) // tilesize, self.tilewidth - 1)
+        top = max(rect.top // tilesize, 0)
+        bottom = min((rect.bottom - 1) // tilesize, self.tileheight - 1)
+        return [pg.Rect(x * tilesize, y * tilesize, tilesize, tilesize)
+                for x in range(left, right + 1) for y in range(top, bottom + 1) if self.data[x][y] == 1]
+
+    def get_cave(self, x, y):
+        """ returns the label of the cave containing the (x, y) position, 0 for walls and tunnels """
+        return int(self.cave_labels[int(x // settings.TILESIZE)][int(y // settings.TILESIZE)])
+
+
+def generate_level(tilewidth, tileheight, seed=None, cache=None):
+    """
+    runs a seeded CellularAutomata and returns the level and its cave labels, going through the cache if there is one
+    a plain module-level function so it can be sent to a worker process
+    """
+    use_cache = cache and seed is not None
+    if use_cache:
+        key = cache.key(tilewidth, tileheight, seed)
+        cached = cache.load(key)
+        if cached:
+            return cached
+
+    generator = CellularAutomata(vectorized=settings.vectorized_mapgen, seed=seed)
+    level = generator.generate_level(tilewidth, tileheight)
+
+    if use_cache:
+        cache.save(key, level, generator.labels)
+    return level, generator.labels
+
+
+class LevelCache:
+    """
+    content-addressed on-disk store for generated levels
+    each level is a pair of .npy files named after a hash of its seed, size and CellularAutomata parameters,
+    which get memory-mapped back in instead of regenerated
+    every new game without a world_seed makes new levels, so past max_bytes the least recently used ones get deleted
+    """
+    version = 3  # bump when the generator changes in a way its params don't capture
+
+    def __init__(self, folder, max_bytes=None):
+        self.folder = folder
+        self.max_bytes = max_bytes  # None for no limit
+
+    def key(self, tilewidth, tileheight, seed):
+        content = {
+            'version': self.version,
+            'size': [tilewidth, tileheight],
+            'seed': seed,
+            'params': CellularAutomata(vectorized=settings.vectorized_mapgen).params,
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def paths(self, key):
+        return path.join(self.folder, key + '.level.npy'), path.join(self.folder, key + '.labels.npy')
+
+    def contains(self, key):
+        return all(path.isfile(file_path) for file_path in self.paths(key))
+
+    def load(self, key):
+        """ returns the (level, cave labels) arrays for key, or None if they aren't cached """
+        try:
+            # copy-on-write, so nothing done to the level in game makes it back to the cache
+            arrays = tuple(np.load(file_path, mmap_mode='c') for file_path in self.paths(key))
+            # the modification time marks when a level was last used, for evict
+            for file_path in self.paths(key):
+                os.utime(file_path)
+            return arrays
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, level, labels):
+        level = np.asarray(level, dtype=np.int8)
+        labels = labels.astype(np.min_scalar_type(int(labels.max())))
+        os.makedirs(self.folder, exist_ok=True)
+        # labels first and level last, since contains() only trusts the pair
+        for file_path, array in reversed(list(zip(self.paths(key), (level, labels)))):
+            temp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_path, file_path)
+        self.evict()
+
+    def evict(self):
+        """ deletes the least recently used levels until the rest fit in max_bytes - the newest one always stays """
+        if self.max_bytes is None:
+            return
+        levels = defaultdict(lambda: [0, 0])  # key => [last used, bytes]
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                level = levels[entry.name.split('.')[0]]
+                level[0] = max(level[0], stat.st_mtime)
+                level[1] += stat.st_size
+
+        total = sum(size for _, size in levels.values())
+        for key, (_, size) in sorted(levels.items(), key=lambda item: item[1][0])[:-1]:
+            if total <= self.max_bytes:
+                break
+            # level first, so contains() stops trusting the pair before the labels go
+            for file_path in self.paths(key):
+                try:
+                    os.remove(file_path)
+                except OSError:  # another process got to it first, or it's still mapped in on windows
+                    pass
+            total -= size
+
 
 class Wall(pg.sprite.Sprite):
-    """ Your basic movement-blocking map element """
+    """ Your basic movement-blocking map element - one merged rectangle of wall tiles (see mesh_walls) """
 
     debugname = 'Wall'
+    images = {}  # one surface per wall size, shared by every wall that size - cleared when the map changes
 
-    def __init__(self, game, start_pos):
+    def __init__(self, game, start_pos, size=(settings.TILESIZE, settings.TILESIZE)):
+        self._layer = layers.wall
         self.groups = game.all_sprites, game.walls
         pg.sprite.Sprite.__init__(self, self.groups)
         self.game = game
-        self.image = pg.Surface((settings.TILESIZE, settings.TILESIZE))
-        self.image.fill(colors.brown)
+        self.image = self.get_image(size)
         self.rect = self.image.get_rect()
         self.x, self.y = start_pos
         self.rect.x = self.x  # * settings.TILESIZE
         self.rect.y = self.y  # * settings.TILESIZE
 
+    @classmethod
+    def get_image(cls, size):
+        if size not in cls.images:
+            image = pg.Surface(size)
+            image.fill(colors.brown)
+            cls.images[size] = image
+        return cls.images[size]
+
+
+def mesh_walls(level):
+    """
+    greedy meshing of the wall tiles into axis-aligned rectangles, returned as (x, y, width, height) in tiles
+    vertical runs of wall are grown sideways for as long as the next column has the exact same run
+    """
+    walls = np.asarray(level) == 1
+    edges = np.diff(np.pad(walls, ((0, 0), (1, 1)), mode='constant').astype(np.int8), axis=1)
+    run_x, run_start = np.nonzero(edges == 1)
+    run_end = np.nonzero(edges == -1)[1]
+
+    rects = []
+    growing = {}  # (start, end) => index of the rect that reached the previous column
+    previous = {}
+    column = None
+    for x, start, end in zip(run_x.tolist(), run_start.tolist(), run_end.tolist()):
+        if x != column:
+            previous = growing if column == x - 1 else {}
+            growing = {}
+            column = x
+        rect = previous.get((start, end))
+        if rect is None:
+            rect = len(rects)
+            rects.append([x, start, 0, end - start])
+        rects[rect][2] += 1
+        growing[(start, end)] = rect
+
+    return [tuple(rect) for rect in rects]
+
 
 class CellularAutomata:
     """
@@ -269,8 +791,10 @@ class CellularAutomata:
     on the Grid Sage Games blog.
     """
 
-    def __init__(self):
+    def __init__(self, vectorized=False, seed=None):
         self.level = []
+        self.random = random.Random(seed)
+        self.np_random = np.random.RandomState(seed)
 
         self.iterations = 30000
         self.neighbors = 4  # number of neighboring walls for this cell to become a wall
@@ -282,36 +806,82 @@ class CellularAutomata:
         self.smooth_edges = True
         self.smoothing = 1
 
-        self.caves = []
-
-    def generate_level(self, map_width, map_height):
+        # vectorized engine - whole-grid passes on an ndarray instead of single-cell updates on nested lists
+        # cell_updates is the average number of updates each cell gets, so the caves look the same at any map size
+        # (tuned against self.iterations on a 60x30 map - synchronous passes converge faster than single updates)
+        self.vectorized = vectorized
+        self.cell_updates = 8
+        self.update_rate = 0.5  # fraction of cells updated per pass, keeps some of the randomness of async updates
+
+        # tunnels - A* with walls costing 1 + tunnel_wall_cost * noise, within tunnel_corridor tiles of a straight line
+        self.tunnel_wall_cost = 2
+        self.tunnel_corridor = 6
+        self.tunnel_noise = None
+
+        self.caves = []  # labels of the caves big enough to keep
+        self.labels = None  # cave label of every tile, 0 for walls
+        self.cave_sizes = None
+        self.cave_bounds = None
+        self.cave_points = None
+        self.connections = None
+
+    @property
+    def params(self):
+        """ everything besides the seed and map size that changes the generated level """
+        return {
+            'iterations': self.iterations,
+            'neighbors': self.neighbors,
+            'wall_probability': self.wall_probability,
+            'room_min_size': self.room_min_size,
+            'room_max_size': self.room_max_size,
+            'smooth_edges': self.smooth_edges,
+            'smoothing': self.smoothing,
+            'vectorized': self.vectorized,
+            'cell_updates': self.cell_updates,
+            'update_rate': self.update_rate,
+            'tunnel_wall_cost': self.tunnel_wall_cost,
+            'tunnel_corridor': self.tunnel_corridor,
+        }
+
+    stages = ('random_fill_map', 'create_caves', 'get_caves', 'connect_caves', 'clean_up_map')
+
+    def generate_level(self, map_width, map_height, timings=None):
+        """ runs every stage in order - pass a dict as timings to get the seconds spent in each stage """
         # Creates an empty 2D array or clears existing array
 
-        self.level = [[1 for _ in range(map_height)] for _ in range(map_width)]
-
-        self.random_fill_map(map_width, map_height)
-
-        self.create_caves(map_width, map_height)
-
-        self.get_caves(map_width, map_height)
-
-        self.connect_caves(map_width, map_height)
+        if self.vectorized:
+            self.level = np.ones((map_width, map_height), dtype=np.int8)
+        else:
+            self.level = [[1 for _ in range(map_height)] for _ in range(map_width)]
 
-        self.clean_up_map(map_width, map_height)
+        for stage in self.stages:
+            start = time.perf_counter()
+            getattr(self, stage)(map_width, map_height)
+            if timings is not None:
+                timings[stage] = time.perf_counter() - start
 
         return self.level
 
     def random_fill_map(self, map_width, map_height):
+        if self.vectorized:
+            fill = self.np_random.random_sample((map_width - 2, map_height - 2)) >= self.wall_probability
+            self.level[1:-1, 1:-1][fill] = 0
+            return
+
         for y in range(1, map_height - 1):
             for x in range(1, map_width - 1):
-                if random.random() >= self.wall_probability:
+                if self.random.random() >= self.wall_probability:
                     self.level[x][y] = 0
 
     def create_caves(self, map_width, map_height):
+        if self.vectorized:
+            self.create_caves_vectorized(map_width, map_height)
+            return
+
         for i in range(0, self.iterations):
             # Pick a random point with a buffer around the edges of the map
-            tile_x = random.randint(1, map_width - 2)  # (2, map_width - 3)
-            tile_y = random.randint(1, map_height - 2)  # (2, map_height - 3)
+            tile_x = self.random.randint(1, map_width - 2)  # (2, map_width - 3)
+            tile_y = self.random.randint(1, map_height - 2)  # (2, map_height - 3)
 
             # if the cell's neighboring walls > self.neighbors, set it to 1
             if self.get_adjacent_walls(tile_x, tile_y) > self.neighbors:
@@ -322,8 +892,28 @@ class CellularAutomata:
 
         self.clean_up_map(map_width, map_height)
 
+    def create_caves_vectorized(self, map_width, map_height):
+        """ same rule as create_caves, but applied to a random subset of the whole grid on each pass """
+        interior = self.level[1:-1, 1:-1]
+        passes = max(1, round(self.cell_updates / self.update_rate))
+        for i in range(passes):
+            walls = count_adjacent_walls(self.level)[1:-1, 1:-1]
+            updating = self.np_random.random_sample(interior.shape) < self.update_rate
+            interior[updating & (walls > self.neighbors)] = 1
+            interior[updating & (walls < self.neighbors)] = 0
+
+        self.clean_up_map(map_width, map_height)
+
     def clean_up_map(self, map_width, map_height):
         if self.smooth_edges:
+            if self.vectorized:
+                interior = self.level[1:-1, 1:-1]
+                for i in range(0, 5):
+                    # remove every wall that sticks out with at most self.smoothing orthogonal neighbors
+                    walls = count_adjacent_walls(self.level, diagonals=False)[1:-1, 1:-1]
+                    interior[(interior == 1) & (walls <= self.smoothing)] = 0
+                return
+
             for i in range(0, 5):
                 # Look at each cell individually and check for smoothness
                 for x in range(1, map_width - 1):
@@ -331,59 +921,75 @@ class CellularAutomata:
                         if (self.level[x][y] == 1) and (self.get_adjacent_walls_simple(x, y) <= self.smoothing):
                             self.level[x][y] = 0
 
-    def create_tunnel(self, point1, point2, current_cave, map_width, map_height):
-        # run a heavily weighted Random Walk from point1 to point1
-        drunkard_x = point2[0]
-        drunkard_y = point2[1]
-
-        while (drunkard_x, drunkard_y) not in current_cave:
-            # Choose direction
-            north = 1.0
-            south = 1.0
-            east = 1.0
-            west = 1.0
-
-            weight = 1
-
-            # weight the random walk against edges
-            if drunkard_x < point1[0]:  # drunkard is left of point1
-                east += weight
-            elif drunkard_x > point1[0]:  # drunkard is right of point1
-                west += weight
-            if drunkard_y < point1[1]:  # drunkard is above point1
-                south += weight
-            elif drunkard_y > point1[1]:  # drunkard is below point1
-                north += weight
-
-            # normalize probabilities so they form a range from 0 to 1
-            total = north + south + east + west
-            north /= total
-            south /= total
-            east /= total
-            west /= total
-
-            # choose the direction
-            choice = random.random()
-            if 0 <= choice < north:
-                dx = 0
-                dy = -1
-            elif north <= choice < (north + south):
-                dx = 0
-                dy = 1
-            elif (north + south) <= choice < (north + south + east):
-                dx = 1
-                dy = 0
-            else:
-                dx = -1
-                dy = 0
-
-            # ==== Walk ====
-            # check colision at edges
-            if (0 < drunkard_x + dx < map_width - 1) and (0 < drunkard_y + dy < map_height - 1):
-                drunkard_x += dx
-                drunkard_y += dy
-                if self.level[drunkard_x][drunkard_y] == 1:
-                    self.level[drunkard_x][drunkard_y] = 0
+    def create_tunnel(self, point1, point2, current_cave, next_cave, map_width, map_height):
+        """
+        digs the cheapest path from point2 (in next_cave) to the first tile of a cave already connected to current_cave
+        A* over the tiles near the straight line between the points - floor is cheap to cross and walls cost extra by
+        a random amount per tile, so the tunnels still wander a bit like the old drunkard walk did
+        the search never leaves that corridor, so it looks at no more than tunnel length * corridor width tiles
+        """
+        if self.tunnel_noise is None:
+            self.tunnel_noise = self.np_random.random_sample((map_width, map_height))
+
+        goal_x, goal_y = point1
+        start_x, start_y = point2
+        line_x, line_y = goal_x - start_x, goal_y - start_y
+        line_length = line_x ** 2 + line_y ** 2 or 1
+        corridor = self.tunnel_corridor ** 2
+
+        def in_corridor(x, y):
+            # squared distance from the closest point of the segment between the points
+            t = min(max(((x - start_x) * line_x + (y - start_y) * line_y) / line_length, 0), 1)
+            return (start_x + t * line_x - x) ** 2 + (start_y + t * line_y - y) ** 2 <= corridor
+
+        start = (start_x, start_y)
+        frontier = [(0, 0, start)]
+        came_from = {start: None}
+        costs = {start: 0}
+        end = start
+        while frontier:
+            _, cost, tile = heapq.heappop(frontier)
+            if cost > costs[tile]:
+                continue
+            x, y = tile
+            label = self.labels[x][y]
+            if label and self.check_connectivity(current_cave, label):
+                end = tile
+                break
+            for neighbor_x, neighbor_y in [(x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)]:
+                if not (0 < neighbor_x < map_width - 1 and 0 < neighbor_y < map_height - 1):
+                    continue
+                if not in_corridor(neighbor_x, neighbor_y):
+                    continue
+                step = 1
+                if self.level[neighbor_x][neighbor_y] == 1:
+                    step += self.tunnel_wall_cost * self.tunnel_noise[neighbor_x, neighbor_y]
+                neighbor = (neighbor_x, neighbor_y)
+                if cost + step < costs.get(neighbor, float('inf')):
+                    costs[neighbor] = cost + step
+                    came_from[neighbor] = tile
+                    # weighted by the average cost of digging through a wall, which keeps the search close to the line
+                    # (it can overestimate where there's floor on the way, the tunnels don't need to be optimal)
+                    estimate = (abs(goal_x - neighbor_x) + abs(goal_y - neighbor_y)) * (1 + self.tunnel_wall_cost / 2)
+                    heapq.heappush(frontier, (cost + step + estimate, cost + step, neighbor))
+
+        # dig it out, walking back from the end
+        tile = end
+        while tile:
+            x, y = tile
+            if self.level[x][y] == 1:
+                self.level[x][y] = 0
+                self.join_caves(x, y, next_cave)
+            elif self.labels[x][y]:
+                self.connections.union(next_cave, self.labels[x][y])
+            tile = came_from[tile]
+
+    def join_caves(self, x, y, cave):
+        """ a tile was just dug out - any cave next to it is now connected to cave """
+        for neighbor_x, neighbor_y in [(x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)]:
+            label = self.labels[neighbor_x][neighbor_y]
+            if label:
+                self.connections.union(cave, label)
 
     def get_adjacent_walls_simple(self, x, y):  # finds the walls in four directions
 
@@ -411,109 +1017,31 @@ class CellularAutomata:
         return wall_counter
 
     def get_caves(self, map_width, map_height):
-        """ locate all the caves within self.level and store them in self.caves """
-        for x in range(0, map_width):
-            for y in range(0, map_height):
-                if self.level[x][y] == 0:
-                    self.flood_fill(x, y)
+        """ label all the caves within self.level, fill in the ones that are too small and store the rest in self.caves """
+        self.labels, self.cave_sizes, self.cave_bounds, self.cave_points = label_caves(self.level)
+
+        too_small = self.cave_sizes < self.room_min_size
+        too_small[0] = False  # walls
+        filled = too_small[self.labels]
+        self.labels[filled] = 0
+        if self.vectorized:
+            self.level[filled] = 1
+        else:
+            for x, y in zip(*np.nonzero(filled)):
+                self.level[x][y] = 1
 
-        for tileset in self.caves:
-            for tile in tileset:
-                self.level[tile[0]][tile[1]] = 0
+        self.caves = [label for label in range(1, len(self.cave_sizes)) if not too_small[label]]
+        self.connections = DisjointSet(len(self.cave_sizes))
 
-    def flood_fill(self, x, y):
+    def connect_caves(self, map_width, map_height):
         """
-        1. flood fill the separate regions of the level
-        2. discard the regions that are smaller than a minimum size
-        3. create a reference for the rest.
+        digs tunnels along a minimum spanning tree of the caves, where each link runs between the closest floor tiles
+        of two neighboring caves (see link_caves) - shortest links first, skipping caves that are already connected
         """
-        cave = set()
-        tile = [(x, y)]
-        to_be_filled = set(tile)
-
-        while to_be_filled:
-            tile = to_be_filled.pop()
-
-            if tile not in cave:
-                cave.add(tile)
-
-                self.level[tile[0]][tile[1]] = 1
-
-                # check adjacent cells
-                x = tile[0]
-                y = tile[1]
-                north = (x, y - 1)
-                south = (x, y + 1)
-                east = (x + 1, y)
-                west = (x - 1, y)
-
-                for direction in [north, south, east, west]:
-
-                    if self.level[direction[0]][direction[1]] == 0:
-                        if direction not in to_be_filled and direction not in cave:
-                            to_be_filled.add(direction)
-
-        if len(cave) >= self.room_min_size:
-            self.caves.append(cave)
-
-    def connect_caves(self, map_width, map_height):
-
-        # Find the closest cave to the current cave
-        for current_cave in self.caves:
-            point1 = next(iter(current_cave))  # get an arbitrary element from cave1
-            point2 = None
-            distance = None
-            for next_cave in self.caves:
-                if next_cave != current_cave and not self.check_connectivity(current_cave, next_cave):
-                    # choose a random point from next_cave
-                    for next_point in next_cave:
-                        break  # get an element from cave1
-                    # compare distance of point1 to old and new point2
-                    new_distance = self.distance_formula(point1, next_point)
-                    if distance is None or (new_distance < float(distance)):
-                        point2 = next_point
-                        distance = new_distance
-
-            if point2:  # if all tunnels are connected, point2 == None
-                self.create_tunnel(point1, point2, current_cave, map_width, map_height)
-
-    @staticmethod
-    def distance_formula(point1, point2):
-        # TODO: Move this somewhere for general use
-        d = sqrt((point2[0] - point1[0]) ** 2 + (point2[1] - point1[1]) ** 2)
-        return d
+        for distance, cave1, cave2, point1, point2 in link_caves(self.labels):
+            if not self.check_connectivity(cave1, cave2):
+                self.create_tunnel(point1, point2, cave1, cave2, map_width, map_height)
 
     def check_connectivity(self, cave1, cave2):
-        # floods cave1, then checks a point in cave2 for the flood
-
-        connected_region = set()
-        start = [next(iter(cave1))]
-        to_be_filled = set(start)
-
-        while to_be_filled:
-            tile = to_be_filled.pop()
-
-            if tile not in connected_region:
-                connected_region.add(tile)
-
-                # check adjacent cells
-                x = tile[0]
-                y = tile[1]
-                north = (x, y - 1)
-                south = (x, y + 1)
-                east = (x + 1, y)
-                west = (x - 1, y)
-
-                for direction in [north, south, east, west]:
-
-                    if self.level[direction[0]][direction[1]] == 0:
-                        if direction not in to_be_filled and direction not in connected_region:
-                            to_be_filled.add(direction)
-
-        end = next(iter(cave2))
-
-        if end in connected_region:
-            return True
-
-        else:
-            return False
+        # caves are merged in self.connections whenever a tunnel joins them, so this is just a label comparison
+        return self.connections.connected(cave1, cave2)
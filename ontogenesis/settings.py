@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from os import path
 from types import SimpleNamespace
 
 import pygame as pg
@@ -64,7 +65,8 @@ colors = SimpleNamespace(
     brown=(106, 55, 5),
     cyan=(0, 255, 255),
     blue=(0, 0, 255),
-    orange=(255, 165, 0)
+    orange=(255, 165, 0),
+    purple=(128, 0, 128)
 )
 
 # configs
@@ -86,6 +88,28 @@ BGCOLOR = colors.darkgrey
 TILESIZE = 32
 MAP_HEIGHT = 30
 MAP_WIDTH = 60
+vectorized_mapgen = True
+mapgen_processes = None  # worker processes for pregenerating levels, None for one per core
+map_memory_budget = 64 * 1024 ** 2  # bytes of level data the worldmap keeps resident
+world_seed = None  # set to reproduce a world, None for a new random one each game
+level_cache_folder = path.join(path.expanduser('~'), '.ontogenesis', 'levels')  # None to turn off the level cache
+level_cache_size = 256 * 1024 ** 2  # bytes of levels kept in the level cache, least recently used go first
+tile_collisions = True  # collide against the map tiles instead of the wall sprites
+batched_mobs = True  # simulate the mobs as whole arrays in a MobSwarm instead of one by one
+stream_chunks = True  # only keep live sprites in the chunks around the viewport - offscreen walls need tile_collisions
+chunk_size = 16  # tiles per side of a streamed chunk
+chunk_margin = 1  # chunks kept live past the edges of the viewport
+flow_field_radius = 40  # tiles around the player that mobs path through, 0 to have them walk straight at the player
+path_cluster_size = 16  # tiles per side of the pathfinder clusters, for mobs past the flow field - 0 to turn it off
+spatial_cell_size = 128  # pixels per cell of the spatial index for mobs
+level_page_size = 64  # tiles per side of the surfaces the floor and walls get baked into
+rotation_step = 5  # degrees between the cached rotations of the mob images
+rotation_cache_size = 1024  # rotated mob images kept around
+text_cache_size = 512  # rendered text surfaces kept around
+lightmap_scale = 4  # the lights get added up at 1/lightmap_scale of the screen resolution
+projectile_light_radius = 48
+lightning_light_radius = 64
+nest_light_radius = 96  # the mob cluster spots glow faintly, 0 to keep them dark
 safe_spawn_dist = 600
 cluster_dist = 20
 pack_size = 3
@@ -8,7 +8,7 @@ from pygame.math import Vector2 as Vec2
 from pygame.locals import SRCALPHA
 
 import settings
-from helpers import get_closest_sprite, calc_dist, get_font_height
+from helpers import get_closest_sprite, calc_dist, get_font, get_font_height
 from settings import layers, colors
 
 
@@ -158,7 +158,10 @@ class Projectile(pg.sprite.Sprite):
         self.pos += self.vel * self.game.delta_time
         self.rect.center = self.pos
         timed_out = pg.time.get_ticks() - self.spawn_time > self.duration
-        hit_wall = pg.sprite.spritecollideany(self, self.game.walls)
+        if settings.tile_collisions:
+            hit_wall = self.game.current_map.get_wall_rects(self.rect)
+        else:
+            hit_wall = pg.sprite.spritecollideany(self, self.game.walls)
         if any([timed_out, hit_wall]):
             self.kill()
 
@@ -355,6 +358,9 @@ class LightningSkill(Skill):
                     # from_pos = self.owner.pos + self.owner.proj_offset.rotate(-self.owner.rot) + offset
                     from_pos = self.owner.projectile_spawn + offset
                     draw_lightning(self.owner.game.effects_screen, from_pos, to_pos)
+                    # the bolt lights up where it hits and along the way
+                    for pos in (target.hit_rect.center, (self.owner.projectile_spawn + target.hit_rect.center) / 2):
+                        self.owner.game.lightmap.add_light(pos, settings.lightning_light_radius, colors.cyan)
                     # now = pg.time.get_ticks()
                     # if now - self.last_tick > 1000 // self.ticks_per_sec:
                     if target.take_damage(self):
@@ -450,8 +456,7 @@ class SkillCard:
         self.use_small = use_small
         self.image = pg.Surface((self.width, self.height))
         self.small_image = None
-        self.font = pg.font.Font(self.game.card_font, self.font_size)
-        self.font.set_bold(True)
+        self.font = get_font(self.game.card_font, self.font_size, bold=True)
         self.font_height = get_font_height(self.font)
         self.text_offset = 3
         self.skill = skill
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from itertools import count
+from math import floor
+
+import pygame as pg
+
+from helpers import calc_dist
+
+
+class SpatialGroup(pg.sprite.Group):
+    """
+    A sprite group that also files its sprites into a uniform grid of buckets by their rect,
+    so rect, radius and nearest-neighbor queries only look at the sprites in the nearby cells
+
+    Membership is kept in sync by the usual group add/remove/kill calls, but moving sprites
+    have to call move() after they change their rect so they get re-filed
+    """
+    def __init__(self, cell_size, *sprites):
+        self.cell_size = cell_size
+        self.buckets = defaultdict(set)
+        self.cells = {}  # sprite => (left, top, right, bottom) range of cells it is filed under
+        self.pending = set()  # sprites added before they had a rect
+        self.serials = {}  # sprite => insertion order, so query results come back in group order
+        self.serial = count()
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, *args):
+        super().add_internal(sprite, *args)
+        self.serials[sprite] = next(self.serial)
+        if hasattr(sprite, 'rect'):
+            self.file(sprite)
+        else:
+            self.pending.add(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.unfile(sprite)
+        self.pending.discard(sprite)
+        del self.serials[sprite]
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        return rect.left // size, rect.top // size, (rect.right - 1) // size, (rect.bottom - 1) // size
+
+    def file(self, sprite):
+        cells = self.cell_range(sprite.rect)
+        self.cells[sprite] = cells
+        left, top, right, bottom = cells
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                self.buckets[x, y].add(sprite)
+
+    def unfile(self, sprite):
+        cells = self.cells.pop(sprite, None)
+        if cells:
+            left, top, right, bottom = cells
+            for x in range(left, right + 1):
+                for y in range(top, bottom + 1):
+                    bucket = self.buckets[x, y]
+                    bucket.discard(sprite)
+                    if not bucket:
+                        del self.buckets[x, y]
+
+    def move(self, sprite):
+        """ re-files a sprite after its rect changed - free if it stayed in the same cells """
+        if sprite not in self.serials:
+            return
+        self.pending.discard(sprite)
+        if self.cells.get(sprite) != self.cell_range(sprite.rect):
+            self.unfile(sprite)
+            self.file(sprite)
+
+    def flush(self):
+        for sprite in self.pending:
+            self.file(sprite)
+        self.pending.clear()
+
+    def in_order(self, sprites):
+        return sorted(sprites, key=self.serials.get)
+
+    def query_cells(self, left, top, right, bottom):
+        found = set()
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                bucket = self.buckets.get((x, y))
+                if bucket:
+                    found.update(bucket)
+        return found
+
+    def query_rect(self, rect):
+        """ sprites whose rect collides with rect """
+        self.flush()
+        candidates = self.query_cells(*self.cell_range(rect))
+        return self.in_order(sprite for sprite in candidates if rect.colliderect(sprite.rect))
+
+    def query_radius(self, pos, radius):
+        """ sprites whose pos is within radius of pos """
+        self.flush()
+        x, y = pos
+        size = self.cell_size
+        candidates = self.query_cells(floor((x - radius) / size), floor((y - radius) / size),
+                                      floor((x + radius) / size), floor((y + radius) / size))
+        return self.in_order(sprite for sprite in candidates if calc_dist(sprite.pos, pos) < radius)
+
+    def nearest(self, pos, k=1, radius=None):
+        """
+        the k sprites closest to pos as (sprite, distance) pairs, closest first
+        searches outwards one ring of cells at a time, and stops once nothing further out could be closer
+        """
+        self.flush()
+        size = self.cell_size
+        cx, cy = floor(pos[0] / size), floor(pos[1] / size)
+        seen = set()
+        distances = []
+        ring = 0
+        while len(seen) < len(self.cells):
+            for x in range(cx - ring, cx + ring + 1):
+                for y in range(cy - ring, cy + ring + 1):
+                    if max(abs(x - cx), abs(y - cy)) != ring:
+                        continue
+                    for sprite in self.buckets.get((x, y), ()):
+                        if sprite not in seen:
+                            seen.add(sprite)
+                            distances.append((calc_dist(sprite.pos, pos), self.serials[sprite], sprite))
+
+            # anything not seen yet is at least this far away
+            reach = ring * size
+            distances.sort(key=lambda item: item[:2])
+            if len(distances) >= k and distances[k - 1][0] <= reach:
+                break
+            if radius is not None and reach >= radius:
+                break
+            ring += 1
+
+        return [(sprite, distance) for distance, _, sprite in distances[:k] if radius is None or distance < radius]
+
+    def collide_group(self, group, dokill=False):
+        """
+        the same result as pg.sprite.groupcollide(self, group, False, dokill), but each sprite in group only
+        gets checked against the sprites near it
+        """
+        hits = {}
+        for other in group.sprites():
+            collided = self.query_rect(other.rect)
+            if collided and dokill:
+                # groupcollide kills it on the first collision, so only the first sprite in group order gets it
+                collided = collided[:1]
+                other.kill()
+            for sprite in collided:
+                hits.setdefault(sprite, []).append(other)
+        return {sprite: hits[sprite] for sprite in self.in_order(hits)}
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from pygame.math import Vector2 as Vec2
+
+import settings
+
+
+class SwarmField:
+    """
+    A mob attribute that lives in its swarm's arrays while the mob is part of one,
+    and in the instance dict otherwise (unbatched mobs, or mobs that haven't been flushed into the swarm yet)
+
+    Vector fields come back as copies, so they have to be assigned to (mob.pos += ...) rather than mutated in place
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, mob, owner):
+        if mob is None:
+            return self
+        swarm = mob.__dict__.get('swarm')
+        if swarm is None:
+            return mob.__dict__[self.name]
+        return swarm.get(mob, self.name)
+
+    def __set__(self, mob, value):
+        swarm = mob.__dict__.get('swarm')
+        if swarm is None:
+            mob.__dict__[self.name] = value
+        else:
+            swarm.set(mob, self.name, value)
+
+
+def neighbor_pairs(points, radius):
+    """
+    all the (i, j) index pairs, i != j, of points that share or touch a grid cell of the given size
+    a superset of the pairs closer than radius, found without comparing every point to every other point
+    """
+    cells = np.floor(points / radius).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # leave an empty border so the neighbor offsets never wrap around
+    stride = cells[:, 1].max() + 2
+    keys = cells[:, 0] * stride + cells[:, 1]
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    pairs_i, pairs_j = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor_keys = keys + dx * stride + dy
+            starts = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+            counts = np.searchsorted(sorted_keys, neighbor_keys, side='right') - starts
+            total = counts.sum()
+            if not total:
+                continue
+            # expand each point's [start, start + count) run of the sorted order into explicit pairs
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            pairs_i.append(np.repeat(np.arange(len(points)), counts))
+            pairs_j.append(order[np.repeat(starts, counts) + offsets])
+
+    if not pairs_i:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    different = i != j
+    return i[different], j[different]
+
+
+def collide_walls(level, pos, vel, size, axis):
+    """
+    vectorized version of Collider.collide against the tile grid, for one axis
+    like the tile backend of Collider.get_hits, the first wall hit is the one furthest left (then furthest up),
+    and the hit rects are clamped to the map
+    """
+    tilesize = settings.TILESIZE
+    tilewidth, tileheight = level.shape
+
+    # pygame rounds the center half away from zero when it gets assigned to a rect
+    center = np.sign(pos) * np.floor(np.abs(pos) + .5)
+    left = center[:, 0].astype(np.int64) - size[:, 0] // 2
+    top = center[:, 1].astype(np.int64) - size[:, 1] // 2
+    x0 = np.maximum(left // tilesize, 0)
+    x1 = np.minimum((left + size[:, 0] - 1) // tilesize, tilewidth - 1)
+    y0 = np.maximum(top // tilesize, 0)
+    y1 = np.minimum((top + size[:, 1] - 1) // tilesize, tileheight - 1)
+
+    # the hit rects are smaller than two tiles, so they overlap at most 3x3 tiles - walk them in x-major order
+    span = 3
+    hit = np.zeros(len(pos), dtype=bool)
+    hit_x = np.zeros(len(pos), dtype=np.int64)
+    hit_y = np.zeros(len(pos), dtype=np.int64)
+    for i in range(span):
+        for j in range(span):
+            x, y = x0 + i, y0 + j
+            inside = (x <= x1) & (y <= y1)
+            wall = inside & (level[np.minimum(x, tilewidth - 1), np.minimum(y, tileheight - 1)] == 1)
+            first = wall & ~hit
+            hit_x[first] = x[first]
+            hit_y[first] = y[first]
+            hit |= wall
+
+    tile = hit_x if axis == 0 else hit_y
+    half = size[:, axis] / 2
+    # compare against the center of the integer rect, like Collider does with hit_rect.centerx
+    rect_center = (left, top)[axis] + size[:, axis] // 2
+    wall_center = tile * tilesize + tilesize // 2
+    before = hit & (wall_center > rect_center)
+    after = hit & (wall_center < rect_center)
+    pos[before, axis] = tile[before] * tilesize - half[before]
+    pos[after, axis] = (tile[after] + 1) * tilesize + half[after]
+    vel[hit, axis] = 0
+
+
+class MobSwarm:
+    """
+    Struct-of-arrays simulation for all the mobs on the current map
+
+    Positions, velocities, speeds, vision and avoidance radii and facing live in contiguous arrays,
+    and steering, separation, integration and wall collision run as whole-array operations once per frame.
+    The Mob sprites read their fields back through SwarmField and only handle rendering and damage
+    """
+    fields = {'pos': 2, 'vel': 2, 'speed': 1, 'vision_distance': 1, 'avoid_radius': 1, 'rot': 1}
+
+    def __init__(self, game, capacity=64):
+        self.game = game
+        self.count = 0
+        self.members = []  # slot => mob
+        self.slots = {}  # mob => slot
+        self.pending = []  # mobs added since the last update, their stats may still get adjusted by subclasses
+        self.arrays = {name: np.zeros((capacity, width) if width > 1 else capacity) for name, width in self.fields.items()}
+        self.hit_size = np.zeros((capacity, 2), dtype=np.int64)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, mob):
+        self.pending.append(mob)
+
+    def remove(self, mob):
+        """ takes a mob out of the simulation, handing its fields back to the instance """
+        if mob in self.pending:
+            self.pending.remove(mob)
+        slot = self.slots.pop(mob, None)
+        if slot is None:
+            return
+        for name in self.fields:
+            mob.__dict__[name] = self.get(mob, name, slot)
+        mob.swarm = None
+
+        # keep the arrays packed by moving the last mob into the hole
+        last = self.count - 1
+        if slot != last:
+            moved = self.members[last]
+            for array in self.arrays.values():
+                array[slot] = array[last]
+            self.hit_size[slot] = self.hit_size[last]
+            self.members[slot] = moved
+            self.slots[moved] = slot
+        self.members.pop()
+        self.count -= 1
+
+    def grow(self, needed):
+        capacity = len(self.hit_size)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name, array in self.arrays.items():
+            grown = np.zeros((capacity,) + array.shape[1:])
+            grown[:self.count] = array[:self.count]
+            self.arrays[name] = grown
+        grown = np.zeros((capacity, 2), dtype=np.int64)
+        grown[:self.count] = self.hit_size[:self.count]
+        self.hit_size = grown
+
+    def flush(self):
+        """ moves the pending mobs into the arrays """
+        self.grow(self.count + len(self.pending))
+        for mob in self.pending:
+            slot = self.count
+            for name in self.fields:
+                self.arrays[name][slot] = mob.__dict__.pop(name)
+            self.hit_size[slot] = mob.hit_rect.size
+            self.members.append(mob)
+            self.slots[mob] = slot
+            mob.swarm = self
+            self.count += 1
+        self.pending.clear()
+
+    def get(self, mob, name, slot=None):
+        value = self.arrays[name][self.slots[mob] if slot is None else slot]
+        if self.fields[name] > 1:
+            return Vec2(*value)
+        return float(value)
+
+    def set(self, mob, name, value):
+        self.arrays[name][self.slots[mob]] = tuple(value) if self.fields[name] > 1 else value
+
+    def update(self):
+        self.flush()
+        n = self.count
+        if not n:
+            return
+
+        dt = self.game.delta_time
+        pos = self.arrays['pos'][:n]
+        vel = self.arrays['vel'][:n]
+        speed = self.arrays['speed'][:n]
+        vision = self.arrays['vision_distance'][:n]
+        avoid_radius = self.arrays['avoid_radius'][:n]
+        rot = self.arrays['rot'][:n]
+        player = self.game.player
+
+        # face the way to the player if the player is close enough and not behind a wall, wander around otherwise
+        seen = self.game.fov.can_see(pos, vision)
+        rot[:] = np.random.randint(0, 361, n)
+        if seen.any():
+            # only the mobs chasing need steering, the wandering ones would just throw it away
+            facing = self.game.flow_field.steer(pos[seen], player.hit_rect.center) - pos[seen]
+            rot[seen] = -np.degrees(np.arctan2(facing[:, 1], facing[:, 0]))
+        radians = np.radians(rot)
+        acc = speed[:, None] * np.column_stack((np.cos(radians), -np.sin(radians)))
+
+        # spread out from the other mobs, which also makes them surround the target
+        if n > 1:
+            i, j = neighbor_pairs(pos, avoid_radius.max())
+            away = pos[i] - pos[j]
+            dist = np.hypot(*away.T)
+            close = (0 < dist) & (dist < avoid_radius[i])
+            np.add.at(acc, i[close], away[close] / dist[close, None] * 10)
+
+        # run forwards, slower when wandering
+        length = np.hypot(*acc.T)
+        scale = np.where(seen, speed, speed * .3) / np.where(length > 0, length, 1)
+        acc *= scale[:, None]
+        acc -= vel
+        vel += acc * dt
+        last_y = pos[:, 1].copy()
+        pos += vel * dt + 0.5 * acc * dt ** 2
+
+        # wall collision - like the sprites, x gets resolved while the hit rect is still at the old y
+        level = self.game.current_map.data
+        probe = np.column_stack((pos[:, 0], last_y))
+        collide_walls(level, probe, vel, self.hit_size[:n], axis=0)
+        pos[:, 0] = probe[:, 0]
+        collide_walls(level, pos, vel, self.hit_size[:n], axis=1)
+
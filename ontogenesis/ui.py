@@ -2,16 +2,14 @@
 
 from collections import defaultdict
 from functools import wraps
-from itertools import chain
 
+import numpy as np
 import pygame as pg
 from pygame.locals import MOUSEMOTION, MOUSEBUTTONUP, MOUSEBUTTONDOWN, SRCALPHA
 from pygame.math import Vector2 as Vec2
 
 import settings
-from enemy import Mob
-from helpers import get_font_height, calc_dist, render_outlined_text
-from map import Wall
+from helpers import get_font, get_font_height, render_text, require_methods, text_cache
 from settings import colors, layers, keybinds
 
 
@@ -48,6 +46,13 @@ class UI:
 
         # hud
         self.minimap = Minimap(self.game)
+        self.hud_widgets = [
+            HealthBar(self.game, 5, 25),
+            ResourceGlobe(self.game),
+            HudText(self.game, self.get_mobcount_text, topright=(settings.WIDTH - 5, 45)),
+            HudText(self.game, self.get_food_text, topright=(settings.WIDTH - 5, 65)),
+            IconBar(self.game),
+        ]
 
         # element group - buttons
         self.all_buttons = set()
@@ -172,23 +177,35 @@ class UI:
         state = self.game.fsm.current_state
         self.draw_text(state, self.game.hud_font, 18, colors.white, settings.WIDTH - 5, 25, align='topright')
 
-    def draw_mobcount(self):
-        mobcount = len(self.game.mobs)
-        self.draw_text('Mobs Remaining: {}'.format(mobcount), self.game.hud_font, 18, colors.white, settings.WIDTH - 5, 45, align='topright')
+    def get_mobcount_text(self):
+        mobcount = len(self.game.mobs) + self.game.chunks.dormant_count
+        return 'Mobs Remaining: {}'.format(mobcount), colors.white
 
-    def draw_food(self):
+    def get_food_text(self):
         food = int(self.game.player.food)
         color = colors.white if food > 30 else colors.orange
         if not food: color = colors.red
-        self.draw_text('Food Remaining: {}'.format(food), self.game.hud_font, 18, color, settings.WIDTH - 5, 65, align='topright')
+        return 'Food Remaining: {}'.format(food), color
 
     def draw_debug_warning(self):
         self.draw_text('DEBUG MODE', self.game.hud_font, 18, colors.white, settings.WIDTH - 5, 5, align='topright')
 
+    def draw_render_stats(self):
+        # these change every frame, so they skip the text cache instead of flooding it
+        font = get_font(self.game.hud_font, 18)
+        lines = [
+            'Sprites drawn: {} culled: {}'.format(self.game.sprites_drawn, self.game.sprites_culled),
+            'Text cache hits: {} misses: {}'.format(text_cache.hits, text_cache.misses),
+            'HUD widget renders: {}'.format(sum(widget.renders for widget in self.hud_widgets)),
+        ]
+        for i, line in enumerate(lines):
+            text_surface = font.render(line, True, colors.white)
+            self.screen.blit(text_surface, text_surface.get_rect(topright=(settings.WIDTH - 5, 85 + i * 20)))
+
     def draw_messages(self):
         if self.game.message_queue:
             size = 24
-            height = get_font_height(pg.font.Font(self.game.hud_font, size))
+            height = get_font_height(get_font(self.game.hud_font, size))
             y_offset = 525
             x_offset = 5
             for i, message in enumerate(self.game.message_queue.getall()):
@@ -198,7 +215,7 @@ class UI:
 
     def draw_flashed_messages(self):
         for i, message in enumerate(self.game.message_flash_queue.get()[::-1]):
-            height = pg.font.Font(self.game.message_flash_font, 40).size(message)[1]
+            height = get_font(self.game.message_flash_font, 40).size(message)[1]
             offset = i * height
             self.draw_outlined_text(
                 message,
@@ -231,41 +248,6 @@ class UI:
             desc = 'NO FOCUS SKILL'
         self.draw_text(desc, self.game.settings_font, 24, colors.white, settings.WIDTH // 2, settings.HEIGHT - 25, align='midbottom')
 
-    def draw_player_health(self, x, y, pct):
-        if pct < 0:
-            pct = 0
-        bar_length = 100
-        bar_height = 20
-        fill = pct * bar_length
-        outline_rect = pg.Rect(x, y, bar_length, bar_height)
-        fill_rect = pg.Rect(x, y, fill, bar_height)
-        if pct > 0.6:
-            col = colors.green
-        elif pct > 0.3:
-            col = colors.yellow
-        else:
-            col = colors.red
-        pg.draw.rect(self.screen, col, fill_rect)
-        pg.draw.rect(self.screen, colors.white, outline_rect, 2)
-
-        # resource globe
-        # TODO: cleanup the variables here
-        if self.game.player.resource_current < self.game.player.equipped['active_skill'].cost:
-            full_img = self.game.mana_full_blink_img
-            empty_img = self.game.mana_empty_blink_img
-        else:
-            full_img = self.game.mana_full_img
-            empty_img = self.game.mana_empty_img
-        resource_pct = self.game.player.resource_current / self.game.player.resource_max
-        height = int(full_img.get_height() * resource_pct)
-        current_img = pg.Surface((full_img.get_width(), height), SRCALPHA)
-        current_img.fill((0, 0, 0, 0))
-        extra_h = 0 - (full_img.get_height() - height)
-        current_img.blit(full_img, (0, extra_h))
-        spacer = 20
-        self.screen.blit(empty_img, (settings.WIDTH - empty_img.get_width() - spacer, settings.HEIGHT - empty_img.get_height() - spacer))
-        self.screen.blit(current_img, (settings.WIDTH - full_img.get_width() - spacer, settings.HEIGHT - current_img.get_height() - spacer))
-
     @staticmethod
     def hide_group(*groups):
         for group in groups:
@@ -404,52 +386,15 @@ class UI:
                 self.draw_text(line, self.game.hud_font, 32, colors.white, settings.WIDTH // 2, settings.HEIGHT // 2 + (i * 32),
                                align='center')
 
-    def draw_icon_bar(self):
-        spacer = 12
-        font = pg.font.Font(self.game.hud_font, 24)
-        font.set_bold(True)
-        font_height = get_font_height(font)
-        icon_size = self.game.configs.icon_size
-        surface = pg.Surface((spacer * 4 + icon_size * 3, spacer * 2 + font_height + icon_size))
-        surface.fill(colors.lightgrey)
-        highlight_size = 2
-        highlight = pg.Surface((highlight_size * 2 + icon_size, highlight_size * 2 + icon_size))
-        highlight.fill(colors.red)
-
-        skills = [
-            self.game.player.equipped['active_skill'],
-            self.game.player.equipped['melee_skill'],
-            self.game.player.equipped['move_skill'],
-        ]
-        for i, skill in enumerate(skills):
-            x = icon_size * i + spacer * (i + 1)
-            y = spacer + font_height
-            if not skill.can_fire:
-                surface.blit(highlight, (x - highlight_size, y - highlight_size))
-            surface.blit(skill.icon, (x, y))
-
-        names = ['ACTIVE', 'MELEE', 'MOVE']
-        for i, name in enumerate(names):
-            text = font.render(name, True, colors.red)
-            text_rect = text.get_rect()
-            text_rect.center = (icon_size * (i + .5) + spacer * (i + 1), (spacer + font_height) // 2)
-            surface.blit(text, text_rect)
-
-        surface_rect = surface.get_rect()
-        surface_rect.midbottom = settings.WIDTH // 2, settings.HEIGHT - 5
-        self.screen.blit(surface, surface_rect)
-
     def draw_hud(self):
         self.hide_group(self.all_buttons, self.all_windows)
 
-        health_pct = self.game.player.hp_current / self.game.player.hp_max
-        self.draw_player_health(5, 25, health_pct)
-        self.draw_mobcount()
-        self.draw_food()
+        # the widgets only re-render when what they show has changed
+        for widget in self.hud_widgets:
+            widget.draw(self.screen)
 
         # self.draw_active_skill()
         # self.draw_focus_skill()
-        self.draw_icon_bar()
 
         self.draw_messages()
         self.optional_messages()
@@ -461,6 +406,8 @@ class UI:
         self.draw_debug_warning()
         # game fsm state
         self.draw_state()
+        if self.game.fsm.current_state == 'playing':
+            self.draw_render_stats()
 
     def optional_messages(self):
         # fps
@@ -468,23 +415,148 @@ class UI:
             self.draw_fps()
 
     def draw_text(self, text, font_name, size, color, x, y, align="topleft"):
-        font = pg.font.Font(font_name, size)
-        text_surface = font.render(text, True, color)
+        text_surface = render_text(text, get_font(font_name, size), color)
         text_rect = text_surface.get_rect(**{align: (x, y)})
         self.screen.blit(text_surface, text_rect)
 
     def draw_outlined_text(self, text, font_name, size, color, outline_color, x, y, align="topleft"):
-        font = pg.font.Font(font_name, size)
-        text_surface = font.render(text, True, color)
-        final_surface = text_surface.copy()
-        outline_surface = font.render(text, True, outline_color)
-        for point in [(-1, -1), (-1, 1), (1, -1), (1, 1)]:
-            final_surface.blit(outline_surface, point)
-        final_surface.blit(text_surface, (0, 0))
+        final_surface = render_text(text, get_font(font_name, size), color, outline_color)
         final_rect = final_surface.get_rect(**{align: (x, y)})
         self.screen.blit(final_surface, final_rect)
 
 
+class HudWidget:
+    """
+    A piece of the HUD that holds on to what it rendered, and only renders again when the state it shows changes
+    Subclasses return that state from get_state (anything that compares equal when nothing visible changed),
+    and turn it into a list of (surface, position) blits in render
+    """
+    def __init__(self, game):
+        require_methods(self, ['get_state', 'render'])
+        self.game = game
+        self.state = None
+        self.blits = None
+        self.renders = 0
+
+    def draw(self, screen):
+        state = self.get_state()
+        if self.blits is None or state != self.state:
+            self.state = state
+            self.blits = self.render(state)
+            self.renders += 1
+        for surface, pos in self.blits:
+            screen.blit(surface, pos)
+
+
+class HudText(HudWidget):
+    """ a line of text - get_text returns it with its color, the rest of the keywords place its rect """
+    def __init__(self, game, get_text, size=18, **position):
+        super().__init__(game)
+        self.get_text = get_text
+        self.size = size
+        self.position = position
+
+    def get_state(self):
+        return self.get_text()
+
+    def render(self, state):
+        text, color = state
+        surface = render_text(text, get_font(self.game.hud_font, self.size), color)
+        return [(surface, surface.get_rect(**self.position))]
+
+
+class HealthBar(HudWidget):
+    """ the player's health, one pixel of bar per percent """
+    bar_length = 100
+    bar_height = 20
+
+    def __init__(self, game, x, y):
+        super().__init__(game)
+        self.pos = (x, y)
+
+    def get_state(self):
+        pct = max(self.game.player.hp_current / self.game.player.hp_max, 0)
+        if pct > 0.6:
+            col = colors.green
+        elif pct > 0.3:
+            col = colors.yellow
+        else:
+            col = colors.red
+        return int(pct * self.bar_length), col
+
+    def render(self, state):
+        fill, col = state
+        surface = pg.Surface((self.bar_length, self.bar_height), SRCALPHA)
+        pg.draw.rect(surface, col, pg.Rect(0, 0, fill, self.bar_height))
+        pg.draw.rect(surface, colors.white, pg.Rect(0, 0, self.bar_length, self.bar_height), 2)
+        return [(surface, self.pos)]
+
+
+class ResourceGlobe(HudWidget):
+    """ the player's resource, filling the globe from the bottom - it blinks when the active skill can't be paid for """
+    spacer = 20
+
+    def get_state(self):
+        player = self.game.player
+        blink = player.resource_current < player.equipped['active_skill'].cost
+        full_img = self.game.mana_full_blink_img if blink else self.game.mana_full_img
+        return blink, int(full_img.get_height() * player.resource_current / player.resource_max)
+
+    def render(self, state):
+        blink, height = state
+        if blink:
+            full_img = self.game.mana_full_blink_img
+            empty_img = self.game.mana_empty_blink_img
+        else:
+            full_img = self.game.mana_full_img
+            empty_img = self.game.mana_empty_img
+        current_img = pg.Surface((full_img.get_width(), height), SRCALPHA)
+        current_img.fill((0, 0, 0, 0))
+        current_img.blit(full_img, (0, height - full_img.get_height()))
+        return [
+            (empty_img, (settings.WIDTH - empty_img.get_width() - self.spacer, settings.HEIGHT - empty_img.get_height() - self.spacer)),
+            (current_img, (settings.WIDTH - full_img.get_width() - self.spacer, settings.HEIGHT - height - self.spacer)),
+        ]
+
+
+class IconBar(HudWidget):
+    """ the equipped skills, outlined in red while they can't fire """
+    names = ['ACTIVE', 'MELEE', 'MOVE']
+    slots = ['active_skill', 'melee_skill', 'move_skill']
+
+    def get_state(self):
+        skills = [self.game.player.equipped[slot] for slot in self.slots]
+        return tuple((skill.icon, skill.can_fire) for skill in skills)
+
+    def render(self, state):
+        spacer = 12
+        font = get_font(self.game.hud_font, 24, bold=True)
+        font_height = get_font_height(font)
+        icon_size = self.game.configs.icon_size
+        surface = pg.Surface((spacer * 4 + icon_size * 3, spacer * 2 + font_height + icon_size))
+        surface.fill(colors.lightgrey)
+        highlight_size = 2
+        highlight = pg.Surface((highlight_size * 2 + icon_size, highlight_size * 2 + icon_size))
+        highlight.fill(colors.red)
+
+        for i, (icon, can_fire) in enumerate(state):
+            x = icon_size * i + spacer * (i + 1)
+            y = spacer + font_height
+            if not can_fire:
+                surface.blit(highlight, (x - highlight_size, y - highlight_size))
+            surface.blit(icon, (x, y))
+
+        for i, name in enumerate(self.names):
+            text = render_text(name, font, colors.red)
+            text_rect = text.get_rect()
+            text_rect.center = (icon_size * (i + .5) + spacer * (i + 1), (spacer + font_height) // 2)
+            surface.blit(text, text_rect)
+
+        surface_rect = surface.get_rect()
+        surface_rect.midbottom = settings.WIDTH // 2, settings.HEIGHT - 5
+        return [(surface, surface_rect)]
+
+
 class Minimap(pg.sprite.Sprite):
     def __init__(self, game):
         self._layer = layers.ui
@@ -509,14 +581,29 @@ class Minimap(pg.sprite.Sprite):
 
         self.offscreen_mob_dirs = set()
         # draw non-player things
-        for sprite in chain(self.game.walls, self.game.mobs):
+        # walls straight from the tiles on screen - the ones in sight, and dimmer the ones seen before
+        fov = self.game.fov
+        view = self.game.camera.viewport
+        xs, ys = fov.window(view)
+        walls = fov.level[xs, ys] != 0
+        tile_colors = np.zeros(walls.shape + (3,), dtype=np.uint8)
+        tile_colors[walls & fov.explored[xs, ys]] = [c // 2 for c in colors.brown]
+        tile_colors[walls & fov.visible[xs, ys]] = colors.brown
+        tiles = pg.surfarray.make_surface(tile_colors)
+        tiles.set_colorkey(colors.black)
+        tilesize = settings.TILESIZE
+        size = (round(walls.shape[0] * tilesize / self.scalex), round(walls.shape[1] * tilesize / self.scaley))
+        corner = ((xs.start * tilesize - view.x) / self.scalex, (ys.start * tilesize - view.y) / self.scaley)
+        self.image.blit(pg.transform.scale(tiles, size), corner)
+
+        player_pos = self.game.camera.apply(self.game.player, hit_rect=True)
+        mobs = list(self.game.mobs)
+        in_sight = fov.visible_at([mob.pos for mob in mobs])
+        for sprite, seen in zip(mobs, in_sight):
             pos = self.game.camera.apply(sprite)
-            player_pos = self.game.camera.apply(self.game.player, hit_rect=True)
-            dist = calc_dist(pos, player_pos)
-            if dist < self.game.player.vision_radius:
-                color = colors.brown if isinstance(sprite, Wall) else colors.red
-                self.image.fill(color, [pos[0] / self.scalex, pos[1] / self.scaley, sizex, sizey])
-            elif isinstance(sprite, Mob):
+            if seen:
+                self.image.fill(colors.red, [pos[0] / self.scalex, pos[1] / self.scaley, sizex, sizey])
+            else:
                 x = 'left' if player_pos.x > pos.x else 'right'
                 y = 'up' if player_pos.y > pos.y else 'down'
                 self.offscreen_mob_dirs.add(x)
@@ -575,7 +662,7 @@ class ImageButton:
         setattr(self.rect, align, (x, y))
 
         self.caption = caption
-        self.font = pg.font.Font(font, self.game.configs.ui_button_text_size)
+        self.font = get_font(font, self.game.configs.ui_button_text_size)
 
         self.visible = True
         self.down = False
@@ -684,7 +771,7 @@ class TextScrollwindow(pg.sprite.Sprite):
         self.items_per_screen = 1
 
         self.visible = True
-        self.font = pg.font.Font(font_path, font_size)
+        self.font = get_font(font_path, font_size)
         self.bg_color = colors.lightgrey
         self.text_color = colors.white
         self.highlight_color = colors.yellow
@@ -744,8 +831,8 @@ class TextScrollwindow(pg.sprite.Sprite):
         # update content
         # render_list_left = [self.font.render(item, 1, self.text_color) for item in self.content_left][self.index:]
         # render_list_right = [self.font.render(item, 1, self.text_color) for item in self.content_right][self.index:]
-        render_list_left = [render_outlined_text(item, self.font, colors.white, colors.black) for item in self.content_left][self.index:]
-        render_list_right = [render_outlined_text(item, self.font, colors.white, colors.black) for item in self.content_right][self.index:]
+        render_list_left = [render_text(item, self.font, colors.white, colors.black) for item in self.content_left][self.index:]
+        render_list_right = [render_text(item, self.font, colors.white, colors.black) for item in self.content_right][self.index:]
         if render_list_left or render_list_right:
             max_height = max([item.get_height() for item in render_list_left] + [item.get_height() for item in render_list_right])
             self.items_per_screen = self.height // max_height
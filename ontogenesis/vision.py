@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pygame as pg
+
+import settings
+
+# transforms from octant coordinates to map offsets, one column per octant
+octants = [
+    [1, 0, 0, -1, -1, 0, 0, 1],
+    [0, 1, -1, 0, 0, -1, 1, 0],
+    [0, 1, 1, 0, 0, -1, -1, 0],
+    [1, 0, 0, 1, -1, 0, 0, -1],
+]
+
+
+class FieldOfView:
+    """
+    What the player can see: recursive shadowcasting over the level tiles, out to the player's vision radius
+
+    visible marks the tiles in sight right now (walls included, they just stop the light), explored every tile
+    that has ever been visible on this level. Both are x-major like the level, and only get recomputed when the
+    player moves into another tile - the minimap, the light filter and the mobs all read the same bitmaps
+    """
+    def __init__(self, level):
+        self.level = np.asarray(level)
+        self.visible = np.zeros(self.level.shape, dtype=bool)
+        self.explored = np.zeros(self.level.shape, dtype=bool)
+        self.origin = None  # tile the bitmap was cast from
+        self.radius = 0  # in tiles
+        self.center = None  # latest position of the viewer, in pixels
+        self.reach = 0  # vision radius in pixels
+        self.masks = {}  # (origin, tile window) => light mask, for the current origin
+
+    @staticmethod
+    def tile_at(pos):
+        return int(pos[0] // settings.TILESIZE), int(pos[1] // settings.TILESIZE)
+
+    def update(self, pos, reach):
+        """ moves the viewer to pos, recasting if that's a different tile (or reach changed), returns whether it did """
+        self.center = np.array(pos, dtype=float)
+        tile = self.tile_at(pos)
+        if tile == self.origin and reach == self.reach:
+            return False
+        self.origin = tile
+        self.reach = reach
+        # one extra tile's corner so every point within reach lands on a tile the bitmap covers
+        self.radius = int(np.ceil(reach / settings.TILESIZE + .5 ** .5))
+
+        self.visible[:] = False
+        x, y = tile
+        width, height = self.level.shape
+        if 0 <= x < width and 0 <= y < height:
+            self.visible[x, y] = True
+            for octant in range(8):
+                self.cast_light(1, 1.0, 0.0, [row[octant] for row in octants])
+        self.explored |= self.visible
+        self.masks.clear()
+        return True
+
+    def cast_light(self, row, start, end, transform):
+        """ lights one octant from row outwards, between the start and end slopes - recursing past every wall run """
+        if start < end:
+            return
+        xx, xy, yx, yy = transform
+        cx, cy = self.origin
+        width, height = self.level.shape
+        radius_squared = self.radius * self.radius
+        new_start = start
+        for distance in range(row, self.radius + 1):
+            dx, dy = -distance - 1, -distance
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                x, y = cx + dx * xx + dy * xy, cy + dx * yx + dy * yy
+                left_slope, right_slope = (dx - .5) / (dy + .5), (dx + .5) / (dy - .5)
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+
+                # anything off the map counts as wall
+                inside = 0 <= x < width and 0 <= y < height
+                if inside and dx * dx + dy * dy <= radius_squared:
+                    self.visible[x, y] = True
+                wall = not inside or self.level[x, y] != 0
+                if blocked:
+                    if wall:
+                        new_start = right_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif wall and distance < self.radius:
+                    blocked = True
+                    self.cast_light(distance + 1, start, left_slope, transform)
+                    new_start = right_slope
+            if blocked:
+                break
+
+    def visible_at(self, positions):
+        """ whether the tiles under positions (in pixels) are in sight """
+        tiles = np.floor(np.asarray(positions, dtype=float).reshape(-1, 2) / settings.TILESIZE).astype(np.int64)
+        inside = (tiles >= 0).all(axis=1) & (tiles < self.visible.shape).all(axis=1)
+        result = np.zeros(len(tiles), dtype=bool)
+        result[inside] = self.visible[tiles[inside, 0], tiles[inside, 1]]
+        return result
+
+    def can_see(self, positions, ranges):
+        """
+        which of positions are within their range of the viewer, with no walls in between
+        line of sight is symmetric, so the bitmap answers for both directions - past its edge only the range counts
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        if self.center is None:
+            return np.zeros(len(positions), dtype=bool)
+        dist = np.hypot(*(positions - self.center).T)
+        return (dist <= ranges) & (self.visible_at(positions) | (dist > self.reach))
+
+    def window(self, rect):
+        """ the x and y slices of the tiles overlapping rect (in pixels), clipped to the map """
+        tilesize = settings.TILESIZE
+        width, height = self.level.shape
+        x0, y0 = max(rect.left // tilesize, 0), max(rect.top // tilesize, 0)
+        x1, y1 = min((rect.right - 1) // tilesize + 1, width), min((rect.bottom - 1) // tilesize + 1, height)
+        return slice(x0, max(x0, x1)), slice(y0, max(y0, y1))
+
+    def get_mask(self, rect, scale=1):
+        """
+        the visible tiles overlapping rect, white on black and scaled up to 1/scale of their size in pixels - with soft
+        edges, for multiplying onto a light filter. returns the mask and the map position of its top left
+        """
+        xs, ys = self.window(rect)
+        key = (xs.start, xs.stop, ys.start, ys.stop, scale)
+        if key not in self.masks:
+            shade = np.where(self.visible[xs, ys], 255, 0).astype(np.uint8)
+            mask = pg.surfarray.make_surface(np.dstack((shade, shade, shade)))
+            size = (shade.shape[0] * settings.TILESIZE // scale, shade.shape[1] * settings.TILESIZE // scale)
+            self.masks[key] = pg.transform.smoothscale(mask, size) if shade.size else pg.Surface(size)
+        return self.masks[key], (xs.start * settings.TILESIZE, ys.start * settings.TILESIZE)
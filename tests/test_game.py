@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+runs the game headless under the SDL dummy drivers - from the repo root:
+
+    python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ontogenesis'))
+
+import numpy as np
+import pygame as pg
+
+import settings
+from game import Game
+
+
+class PureMapgenTest(unittest.TestCase):
+    """ the pure-Python level generator (vectorized_mapgen=False) has to give the same kind of level as the numpy one """
+
+    def setUp(self):
+        self.saved = settings.vectorized_mapgen, settings.level_cache_folder, settings.SYSTEM_DEBUG
+        settings.vectorized_mapgen = False
+        settings.level_cache_folder = None
+        settings.SYSTEM_DEBUG = False
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.game = Game(name='Test')
+        except FileNotFoundError as e:
+            pg.quit()
+            settings.vectorized_mapgen, settings.level_cache_folder, settings.SYSTEM_DEBUG = self.saved
+            self.skipTest('game assets missing: {}'.format(e))
+
+    def tearDown(self):
+        self.game.level_pool.shutdown(wait=True)
+        pg.quit()
+        settings.vectorized_mapgen, settings.level_cache_folder, settings.SYSTEM_DEBUG = self.saved
+
+    def test_one_tick(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.game.new()
+            self.game.delta_time = 1 / 60
+            self.game.update()
+            self.game.draw()
+        self.assertIsInstance(self.game.current_map.data, np.ndarray)
+        self.assertEqual(self.game.current_map.data.dtype, np.int8)
+
+
+if __name__ == '__main__':
+    unittest.main()
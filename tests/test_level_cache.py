@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ontogenesis'))
+
+import numpy as np
+
+from map import LevelCache
+
+
+class LevelCacheTest(unittest.TestCase):
+    """ past max_bytes the cache drops its least recently used levels """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.level = np.zeros((64, 64), dtype=np.int8)
+        self.labels = np.ones((64, 64), dtype=np.int8)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def fill(self, cache, keys):
+        for i, key in enumerate(keys):
+            cache.save(key, self.level, self.labels)
+            # spread the modification times out, some filesystems only keep whole seconds
+            for file_path in cache.paths(key):
+                os.utime(file_path, (time.time() - 100 + i, time.time() - 100 + i))
+
+    def test_unlimited(self):
+        cache = LevelCache(self.folder.name)
+        self.fill(cache, ['a', 'b', 'c'])
+        self.assertTrue(all(cache.contains(key) for key in 'abc'))
+
+    def test_evicts_least_recently_used(self):
+        level_bytes = sum(os.path.getsize(file_path) for file_path in self.saved_paths())
+        cache = LevelCache(self.folder.name, max_bytes=2 * level_bytes)
+        self.fill(cache, ['a', 'b'])
+        self.assertIsNotNone(cache.load('a'))  # a is now newer than b
+        cache.save('c', self.level, self.labels)
+        self.assertTrue(cache.contains('a'))
+        self.assertFalse(cache.contains('b'))
+        self.assertTrue(cache.contains('c'))
+
+    def test_keeps_newest_over_budget(self):
+        cache = LevelCache(self.folder.name, max_bytes=1)
+        self.fill(cache, ['a', 'b'])
+        self.assertFalse(cache.contains('a'))
+        self.assertTrue(cache.contains('b'))
+
+    def saved_paths(self):
+        """ the files of one level, saved in a folder of their own to measure it """
+        folder = tempfile.mkdtemp(dir=self.folder.name)
+        cache = LevelCache(folder)
+        cache.save('x', self.level, self.labels)
+        return cache.paths('x')
+
+
+if __name__ == '__main__':
+    unittest.main()
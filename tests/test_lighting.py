@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ontogenesis'))
+
+import pygame as pg
+
+from lighting import Lightmap
+from settings import colors
+
+
+class StaticLightTest(unittest.TestCase):
+    """ the static layer gets reused while the view stays inside its margin, and rebuilt once it doesn't """
+
+    def setUp(self):
+        light_image = pg.Surface((64, 64))
+        light_image.fill(colors.white)
+        self.lightmap = Lightmap((320, 240), 4, light_image, margin=64)
+        self.lightmap.add_static_light((100, 100), 32)
+        self.screen = pg.Surface((320, 240))
+
+    def render(self, x, y):
+        self.screen.fill(colors.white)
+        self.lightmap.render(self.screen, pg.Rect(x, y, 320, 240))
+        return self.lightmap.static_layer
+
+    def test_reused_inside_margin(self):
+        layer = self.render(0, 0)
+        self.assertIs(self.render(60, -60), layer)
+
+    def test_rebuilt_past_margin(self):
+        layer = self.render(0, 0)
+        self.assertIsNot(self.render(100, 0), layer)
+
+    def test_rebuilt_when_lights_change(self):
+        layer = self.render(0, 0)
+        self.lightmap.add_static_light((200, 100), 32)
+        self.assertIsNot(self.render(0, 0), layer)
+
+    def test_lit_where_the_light_is(self):
+        self.render(0, 0)
+        self.assertEqual(self.screen.get_at((100, 100))[:3], colors.white)
+        self.assertEqual(self.screen.get_at((300, 220))[:3], colors.black)
+
+
+if __name__ == '__main__':
+    unittest.main()
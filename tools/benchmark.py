@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+headless benchmarks for the procedural generation - run from the repo root:
+
+    python tools/benchmark.py --output bench.json
+    python tools/benchmark.py --baseline bench.json
+
+every case runs with fixed seeds under the SDL dummy drivers, timings are the median of --repeat runs
+and memory is the tracemalloc peak of one extra run. with --baseline, anything that got slower (or bigger)
+than --tolerance allows is reported and the script exits with 1
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ontogenesis'))
+
+import numpy as np
+import pygame as pg
+
+import settings
+from game import Game
+from map import CellularAutomata, Map, WorldMap
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def parse_sizes(text):
+    return [tuple(int(n) for n in size.split('x')) for size in text.split(',')]
+
+
+def measure(run, repeat):
+    """
+    calls run() repeat times - run returns a dict of name => seconds for one go
+    returns name => timing summary, with the tracemalloc peak of one more run under the 'total' entry
+    """
+    samples = {}
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            timings = run()
+        for name, seconds in timings.items():
+            samples.setdefault(name, []).append(seconds)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results = {name: {'median': statistics.median(times), 'min': min(times), 'runs': len(times)}
+               for name, times in samples.items()}
+    results['total']['peak_bytes'] = peak
+    return results
+
+
+def bench_cellular_automata(width, height, seed):
+    def run():
+        timings = {}
+        start = time.perf_counter()
+        CellularAutomata(vectorized=settings.vectorized_mapgen, seed=seed).generate_level(width, height, timings=timings)
+        timings['total'] = time.perf_counter() - start
+        return timings
+    return run
+
+
+def bench_worldmap_graph(worldmap, width, height, seed):
+    def run():
+        worldmap.width, worldmap.height = width, height
+        worldmap.random = random.Random(seed)
+        start = time.perf_counter()
+        worldmap.generate_graph()
+        return {'total': time.perf_counter() - start}
+    return run
+
+
+def bench_generate_maptiles(game, width, height, seed):
+    # built out here, since a new Map generates its level - which would land in the measured memory
+    level_map = Map(game, width, height, seed=seed)
+    level, labels = level_map.data, level_map.cave_labels
+
+    def run():
+        for sprite in game.all_sprites:
+            sprite.kill()
+        level_map.set_level(level, labels)
+        level_map.clusters = []
+        level_map.player_start = None
+        game.current_map = level_map
+        start = time.perf_counter()
+        game.generate_maptiles()
+        return {'total': time.perf_counter() - start}
+    return run
+
+
+def make_game(seed):
+    """ a real Game, minus the level cache and the background level generation """
+    settings.SYSTEM_DEBUG = False
+    settings.level_cache_folder = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        game = Game(name='Benchmark')
+        game.configs.debug = False
+        game.worldmap = WorldMap(game, seed=seed)
+        game.worldmap.release_all()
+        game.level_pool.shutdown(wait=True)
+    return game
+
+
+def run_benchmarks(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    game = make_game(args.seed)
+
+    results = {}
+    for width, height in args.sizes:
+        print('cellular automata {}x{}'.format(width, height))
+        for name, result in measure(bench_cellular_automata(width, height, args.seed), args.repeat).items():
+            results['cellular_automata/{}x{}/{}'.format(width, height, name)] = result
+
+    # the graph cases regenerate the game's own worldmap graph, so put it back afterwards
+    worldmap = game.worldmap
+    graph, world_width, world_height = worldmap.graph, worldmap.width, worldmap.height
+    for width, height in args.world_sizes:
+        print('worldmap graph {}x{}'.format(width, height))
+        result = measure(bench_worldmap_graph(worldmap, width, height, args.seed), args.repeat)
+        results['worldmap_graph/{}x{}'.format(width, height)] = result['total']
+    worldmap.graph, worldmap.width, worldmap.height = graph, world_width, world_height
+
+    for width, height in args.sizes:
+        print('generate_maptiles {}x{}'.format(width, height))
+        result = measure(bench_generate_maptiles(game, width, height, args.seed), args.repeat)
+        results['generate_maptiles/{}x{}'.format(width, height)] = result['total']
+
+    pg.quit()
+
+    meta = {
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'vectorized_mapgen': settings.vectorized_mapgen,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pygame': pg.version.ver,
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if resource:
+        # kilobytes on linux, bytes on mac
+        meta['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'meta': meta, 'results': results}
+
+
+def compare(report, baseline, tolerance, min_delta):
+    """ prints every case next to its baseline, returns the names of the ones that regressed """
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(name)
+        if not base:
+            print('{:<50} {:>10.2f} ms   (new)'.format(name, result['median'] * 1000))
+            continue
+
+        ratio = result['median'] / base['median'] if base['median'] else 1
+        slower = ratio > 1 + tolerance and result['median'] - base['median'] > min_delta
+        bigger = 'peak_bytes' in result and 'peak_bytes' in base and result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance)
+        flag = ' SLOWER' if slower else ''
+        flag += ' BIGGER' if bigger else ''
+        print('{:<50} {:>10.2f} ms   {:>6.2f}x{}'.format(name, result['median'] * 1000, ratio, flag))
+        if slower or bigger:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=parse_sizes, default='60x30,120x60,240x120', help='level sizes in tiles')
+    parser.add_argument('--world-sizes', type=parse_sizes, default='12x10,50x50,150x150', help='worldmap sizes in cells')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='where to write the json report')
+    parser.add_argument('--baseline', help='json report to compare against')
+    parser.add_argument('--tolerance', type=float, default=.25, help='allowed slowdown/growth, as a fraction')
+    parser.add_argument('--min-delta', type=float, default=.001, help='slowdowns under this many seconds are noise')
+
+    args = parser.parse_args()
+    report = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = {'results': {}}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(report, baseline, args.tolerance, args.min_delta)
+
+    if regressions:
+        print('{} regression(s) against {}'.format(len(regressions), args.baseline))
+        sys.exit(1)